@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import distribution
+import select_trips
+import tour_io
+import decorate_tours
+import overpass_client
+from metrics import metrics
+from benchmarks import synthetic_data
+from benchmarks import stub_overpass
+
+# Times each stage of the pipeline on synthetic inputs and a local stub
+# Overpass server and saves the results as json, so runs on different
+# commits can be compared with --compare.
+
+def time_stage(results, name, items, function):
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    results[name] = {"seconds" : seconds, "items" : items,
+            "items_per_second" : items / seconds if seconds > 0 else None}
+    print("{:<24} {:>10.3f}s {:>14.1f}/s".format(name, seconds, results[name]["items_per_second"] or 0.0))
+    return value
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(args, workdir):
+    np.random.seed(args.seed)
+    nhts_folder = os.path.join(workdir, "nhts-data/")
+    synthpop_folder = os.path.join(workdir, "synthpop-data/")
+    synthetic_data.write_nhts(nhts_folder, args.nhts_people, args.seed)
+    synthetic_data.write_synthpop(synthpop_folder, args.synthpop_people, args.seed)
+    results = dict()
+
+    nhts_info = time_stage(results, "load_csv", args.nhts_people,
+            lambda: distribution.NHTS_Data(nhts_folder, use_cache=False))
+    distribution.NHTS_Data(nhts_folder, rebuild_cache=True)
+    time_stage(results, "load_cache", args.nhts_people,
+            lambda: distribution.NHTS_Data(nhts_folder))
+    synthpop_info = distribution.Synthpop_Data(synthpop_folder)
+
+    # Undo the split to get back the table it starts from
+    unsplit = nhts_info.nhts_data[nhts_info.nhts_data.TDTRPNUM % 1 == 0]
+    time_stage(results, "split_round_trips", len(unsplit.index),
+            lambda: distribution.split_round_trips(unsplit.copy()))
+
+    def sample_tours():
+        for _ in range(args.tours):
+            nhts_info.sample_tour(*synthpop_info.sample_user())
+    time_stage(results, "sample_tour", args.tours, sample_tours)
+    tours = time_stage(results, "create_tour", args.tours, lambda: [
+            {"Tour {}".format(i): select_trips.create_tour(nhts_info, synthpop_info)}
+            for i in range(args.tours)])
+    batched_tours = time_stage(results, "create_tours_batched", args.batched_tours, lambda: [
+            tour for batch in select_trips.generate_tour_batches(
+            nhts_info, synthpop_info, args.batched_tours, args.batch_size) for tour in batch])
+
+    for name, tour_file in [("read_tours_json", "tours.json"), ("read_tours_columns", "tours.tours")]:
+        tour_file = os.path.join(workdir, tour_file)
+        tour_io.write_tours(batched_tours, tour_file)
+        time_stage(results, name, len(batched_tours),
+                lambda: sum(1 for _ in tour_io.read_tours(tour_file)))
+
+    # The stub runs in its own process so its work isn't timed as decoration
+    server, url = stub_overpass.start_server_process(latency=args.latency, density=args.density)
+    try:
+        decorate_tours.overpass_client = overpass_client.OverpassClient(url)
+        decorate_tours.location_backend = None
+        decorate_tours.logging_file = open(os.devnull, "w")
+        home_options = decorate_tours.get_home_locations()
+        metrics.reset()
+        decorated = time_stage(results, "decorate_tour", args.decorated_tours, lambda: [
+                decorate_tours.decorate_tour(tour, home_options)
+                for tour in tours[:args.decorated_tours]])
+        results["decorate_tour"]["overpass_queries"] = metrics.summary()["counters"].get(
+                "overpass_requests", 0)
+    finally:
+        server.terminate()
+        server.join()
+
+    persons = [(endpoints, tour) for endpoints, tour in zip(decorated, tours) if endpoints is not None]
+    def serialize():
+        with decorate_tours.open_population(os.path.join(workdir, "population.xml")) as writer:
+            for i in range(args.serialized_persons):
+                endpoints, tour = persons[i % len(persons)]
+                decorate_tours.append_trips(writer, endpoints, tour)
+    time_stage(results, "xml_serialization", args.serialized_persons, serialize)
+    return results
+
+def compare(results, baseline_file):
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)["stages"]
+    print("\n{:<24} {:>12} {:>12} {:>8}".format("stage", "baseline", "current", "speedup"))
+    for name, result in results.items():
+        if name in baseline:
+            old, new = baseline[name]["seconds"], result["seconds"]
+            print("{:<24} {:>11.3f}s {:>11.3f}s {:>7.2f}x".format(name, old, new, old / new))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nhts_people", type=int, help="NHTS people to generate", default=20000)
+    parser.add_argument("--synthpop_people", type=int, help="Synthpop people to generate",
+        default=20000)
+    parser.add_argument("--tours", type=int, help="Tours for the per tour stages", default=1000)
+    parser.add_argument("--batched_tours", type=int, help="Tours for batched generation",
+        default=20000)
+    parser.add_argument("--batch_size", type=int, help="Batch size for batched generation",
+        default=10000)
+    parser.add_argument("--decorated_tours", type=int, help="Tours to decorate", default=50)
+    parser.add_argument("--serialized_persons", type=int, help="Persons to write as XML",
+        default=10000)
+    parser.add_argument("--latency", type=float, help="Stub Overpass latency per query in seconds",
+        default=0.0)
+    parser.add_argument("--density", type=float, help="Stub Overpass POIs per tag and grid cell",
+        default=0.05)
+    parser.add_argument("--seed", type=int, help="Seed for the data and the run", default=0)
+    parser.add_argument("--output", type=str, help="File to save the results to",
+        default="benchmarks/results/latest.json")
+    parser.add_argument("--compare", type=str, help="Earlier results file to compare against",
+        default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        # decorate_tours writes logs.txt in the working directory
+        os.chdir(workdir)
+        try:
+            results = run_benchmarks(args, workdir)
+        finally:
+            os.chdir(cwd)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"commit" : get_commit(), "timestamp" : time.time(),
+                "python" : platform.python_version(), "config" : vars(args),
+                "stages" : results}, f, indent=4)
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import decorate_tours
+from benchmarks import synthetic_data
+from benchmarks import stub_overpass
+
+# Runs main.py for --help and each --mode under python -X importtime on tiny
+# synthetic inputs and checks what each run imported against its budget:
+# packages it must never load and a cap on the total import time. Exits with
+# status 1 if any budget is exceeded, so it can guard startup in CI.
+
+main_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+# name -> (main.py arguments, packages that must not be imported, max import seconds)
+budgets = {
+    "help" : (["--help"], ["numpy", "pandas", "scipy", "lxml", "requests"], 0.05),
+    "mode1" : (["--mode", "1", "--num_tours", "20", "--tour_json", "tours.json"],
+        ["scipy", "lxml", "requests"], 0.6),
+    "mode1_workers" : (["--mode", "1", "--num_tours", "20", "--tour_json", "tours_w.json",
+        "--workers", "2"], ["scipy", "lxml", "requests"], 0.6),
+    "mode2" : (["--mode", "2", "--tour_json", "tours.json", "--overpass_url", "{url}",
+        "--seed", "1", "--output_file", "population.xml"], ["pandas", "scipy"], 0.4),
+    "mode2_osm" : (["--mode", "2", "--tour_json", "tours.json", "--location_backend", "osm",
+        "--osm_file", "poi.geojson", "--osm_index", "poi_index.npz", "--seed", "1",
+        "--output_file", "population.xml"], ["pandas", "scipy", "requests"], 0.3),
+    "mode3" : (["--mode", "3", "--num_tours", "20", "--tour_json", "tours3.json",
+        "--overpass_url", "{url}", "--seed", "1", "--output_file", "population.xml"],
+        ["scipy"], 0.8),
+}
+
+def parse_importtime(stderr):
+    # Returns the total import seconds and the set of top level packages
+    # imported. Lines look like
+    #   import time: self [us] | cumulative | imported package
+    #   import time:       313 |        313 |     _io
+    # where nested imports are indented two more spaces per level.
+    total = 0
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if len(name) - len(name.lstrip()) == 1:
+            total += int(cumulative)
+        packages.add(name.strip().split(".")[0])
+    return total / 1e6, packages
+
+def write_geojson(geojson_file, seed):
+    # Points for every searched tag around the area homes are picked from
+    rng = np.random.default_rng(seed)
+    features = []
+    for key, value in sorted(decorate_tours.get_search_tags()):
+        for lat, lon in zip(37.6 + rng.random(200) * 0.5, -122.5 + rng.random(200) * 0.5):
+            features.append({"type" : "Feature", "properties" : {key : value},
+                    "geometry" : {"type" : "Point", "coordinates" : [lon, lat]}})
+    with open(geojson_file, "w") as f:
+        json.dump({"type" : "FeatureCollection", "features" : features}, f)
+
+def measure(name, arguments, workdir, url, repeats):
+    # Fastest of repeats runs, to keep out noise from the rest of the machine
+    arguments = [argument.format(url=url) for argument in arguments]
+    best = None
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-X", "importtime", main_file] + arguments,
+                cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError("{} failed:\n{}".format(name, result.stderr[-2000:]))
+        seconds, packages = parse_importtime(result.stderr)
+        if best is None or seconds < best[0]:
+            best = (seconds, packages)
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, help="Runs per case, the fastest counts", default=3)
+    parser.add_argument("--budget_scale", type=float,
+        help="Multiply the import time budgets, e.g. for slow machines", default=1.0)
+    parser.add_argument("--output", type=str, help="File to save the results to",
+        default="benchmarks/results/startup.json")
+    args = parser.parse_args()
+
+    results = dict()
+    over_budget = []
+    server, url = stub_overpass.start_server(stub_overpass.StubOverpass())
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            synthetic_data.write_nhts(os.path.join(workdir, "nhts-data/"), 500)
+            synthetic_data.write_synthpop(os.path.join(workdir, "synthpop-data/"), 500)
+            write_geojson(os.path.join(workdir, "poi.geojson"), 0)
+            print("{:<14} {:>10} {:>10}  {}".format("case", "imports", "budget", "forbidden imports"))
+            for name, (arguments, forbidden, max_seconds) in budgets.items():
+                seconds, packages = measure(name, arguments, workdir, url, args.repeats)
+                max_seconds *= args.budget_scale
+                loaded = sorted(set(forbidden) & packages)
+                results[name] = {"import_seconds" : seconds, "budget_seconds" : max_seconds,
+                        "forbidden_imports" : loaded, "packages" : sorted(packages)}
+                if seconds > max_seconds or loaded:
+                    over_budget.append(name)
+                print("{:<14} {:>9.3f}s {:>9.3f}s  {}".format(name, seconds, max_seconds,
+                        ", ".join(loaded) or "-"))
+    finally:
+        server.shutdown()
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    if over_budget:
+        print("Over budget: {}".format(", ".join(over_budget)))
+        sys.exit(1)
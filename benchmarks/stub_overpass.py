@@ -0,0 +1,187 @@
+import argparse
+import json
+import math
+import multiprocessing
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+
+# Local stand-in for an Overpass server. It answers the node queries that
+# decorate_tours sends with made up POIs and serves api/status. POIs are
+# generated per (tag, grid cell) from a fixed seed, so the same place always
+# has the same POIs no matter which box is asked for. The POIs of every cell
+# in a box come from hashes of the tag and cell, computed for all cells at
+# once, so even boxes spanning degrees are cheap to answer. Run it with
+# start_server_process when timing code, so its work isn't counted.
+
+clause_pattern = re.compile(r'node\["([^"]*)"="([^"]*)"\]\(([-0-9.e]+),([-0-9.e]+),([-0-9.e]+),([-0-9.e]+)\)')
+
+class StubOverpass:
+
+    def __init__(self, latency=0.0, density=0.05, cell_size=0.01, max_elements=None,
+            rate_limit=0, seed=0):
+        # Seconds to wait before answering each query
+        self.latency = latency
+        # Average POIs per tag in each grid cell
+        self.density = density
+        self.cell_size = cell_size
+        # Most elements to answer with. Like Overpass running out of memory,
+        # hitting it makes the answer a runtime error. None means no limit.
+        self.max_elements = max_elements
+        self.rate_limit = rate_limit
+        self.seed = seed
+        self.queries = 0
+        self.lock = threading.Lock()
+        # Cumulative Poisson probabilities for drawing POI counts per cell
+        self.count_cdf = np.ones(1)
+        if density > 0:
+            counts = np.arange(int(density * 10) + 20)
+            log_pmf = counts * math.log(density) - density - np.cumsum(np.log(np.maximum(counts, 1)))
+            self.count_cdf = np.cumsum(np.exp(log_pmf))
+
+    def get_nodes(self, key, value, min_row, max_row, min_col, max_col):
+        # (ids, lats, lons) of the POIs tagged key=value in the grid cells
+        # from min_row to max_row and min_col to max_col
+        rows, cols = np.meshgrid(np.arange(min_row, max_row + 1, dtype=np.int64),
+                np.arange(min_col, max_col + 1, dtype=np.int64), indexing="ij")
+        rows, cols = rows.ravel(), cols.ravel()
+        tag_seed = np.uint64(zlib.crc32("{}={}:{}".format(key, value, self.seed).encode()))
+        cell_hash = mix(mix(tag_seed ^ mix((rows + (1 << 20)).astype(np.uint64)))
+                ^ (cols + (1 << 20)).astype(np.uint64))
+        counts = np.searchsorted(self.count_cdf, get_uniform(cell_hash), side="right")
+        cell = np.repeat(np.arange(rows.shape[0]), counts)
+        index = np.arange(cell.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        node_hash = mix(cell_hash[cell] ^ mix(index.astype(np.uint64) + np.uint64(1)))
+        lats = (rows[cell] + get_uniform(node_hash)) * self.cell_size
+        lons = (cols[cell] + get_uniform(mix(node_hash))) * self.cell_size
+        ids = (cell_hash[cell] >> np.uint64(14)).astype(np.int64) * 64 + index
+        return ids, lats, lons
+
+    def query(self, overpass_query):
+        with self.lock:
+            self.queries += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        elements = dict()
+        for key, value, *bbox in clause_pattern.findall(overpass_query):
+            min_lat, min_lon, max_lat, max_lon = [float(x) for x in bbox]
+            min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+            min_lon, max_lon = max(min_lon, -180.0), min(max_lon, 180.0)
+            ids, lats, lons = self.get_nodes(key, value, math.floor(min_lat / self.cell_size),
+                    math.floor(max_lat / self.cell_size), math.floor(min_lon / self.cell_size),
+                    math.floor(max_lon / self.cell_size))
+            in_box = (lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)
+            for node_id, lat, lon in zip(ids[in_box].tolist(), lats[in_box].tolist(),
+                    lons[in_box].tolist()):
+                element = elements.setdefault(node_id, {"type" : "node", "id" : node_id,
+                        "lat" : lat, "lon" : lon, "tags" : dict()})
+                element["tags"][key] = value
+                if self.is_full(elements):
+                    break
+            if self.is_full(elements):
+                break
+        # Overpass outputs nodes sorted by id
+        result = {"version" : 0.6, "generator" : "stub",
+                "elements" : [elements[node_id] for node_id in sorted(elements)]}
+        if self.is_full(elements):
+            # Overpass reports the error in a remark next to the partial output
+            result["remark"] = ("runtime error: Query ran out of memory after {} elements"
+                    .format(len(elements)))
+        return result
+
+    def is_full(self, elements):
+        return self.max_elements is not None and len(elements) >= self.max_elements
+
+    def status(self):
+        return ("Connected as: 0\nCurrent time: {}\nRate limit: {}\n{} slots available now.\n"
+                "Currently running queries (pid, space limit, time limit, start time):\n").format(
+                time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), self.rate_limit, self.rate_limit)
+
+def mix(x):
+    # splitmix64 finalizer, an invertible mix of the bits of uint64 values
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def get_uniform(x):
+    # Floats in [0, 1) from the top 53 bits of uint64 hashes
+    return (x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, which Nagle's algorithm
+        # would hold up until the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, body, content_type):
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.startswith("/api/status"):
+                self.send(stub.status(), "text/plain")
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            if body.startswith("data="):
+                body = parse_qs(body)["data"][0]
+            self.send(json.dumps(stub.query(body)), "application/json")
+    return Handler
+
+def start_server(stub, port=0):
+    # Serves stub in a background thread and returns the server and its url
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(stub))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://127.0.0.1:{}/".format(server.server_port)
+
+def start_server_process(port=0, **settings):
+    # Serves a StubOverpass(**settings) from its own process and returns the
+    # process and its url. Stop it with process.terminate().
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve_in_process,
+            args=(settings, port, child_connection), daemon=True)
+    process.start()
+    port = parent_connection.recv()
+    return process, "http://127.0.0.1:{}/".format(port)
+
+def serve_in_process(settings, port, connection):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(StubOverpass(**settings)))
+    server.daemon_threads = True
+    connection.send(server.server_port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, help="Port to listen on", default=8080)
+    parser.add_argument("--latency", type=float, help="Seconds to wait per query", default=0.0)
+    parser.add_argument("--density", type=float, help="Average POIs per tag and grid cell",
+        default=0.05)
+    parser.add_argument("--rate_limit", type=int, help="Rate limit reported by api/status",
+        default=0)
+    parser.add_argument("--max_elements", type=int,
+        help="Answer queries that reach this many elements with a runtime error", default=None)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(("0.0.0.0", args.port), make_handler(
+        StubOverpass(args.latency, args.density, max_elements=args.max_elements,
+            rate_limit=args.rate_limit)))
+    server.daemon_threads = True
+    print("Serving a stub Overpass API on port {}".format(args.port))
+    server.serve_forever()
@@ -0,0 +1,77 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# Writes synthetic stand-ins for nhts-data/perpub.csv, nhts-data/trippub.csv
+# and synthpop-data/person.csv with the columns NHTS_Data and Synthpop_Data
+# read. Most people make valid home based tours, and a small share hits each
+# of the filters in NHTS_Data.load_nhts_data so those passes do real work.
+# Filler columns make the files about as wide as the real ones.
+
+purposes = [3, 5, 6, 8, 9, 11, 12, 13, 14, 15, 16, 17, 18, 19]
+modes = [1, 2, 3, 4, 5, 6, 7, 10, 11, 15, 17, 18]
+
+def add_filler_columns(df, count, rng):
+    for i in range(count):
+        df["FILLER{}".format(i)] = rng.integers(-9, 100, len(df.index))
+    return df
+
+def write_nhts(datafolder, num_people, seed=0, filler_columns=40):
+    rng = np.random.default_rng(seed)
+    os.makedirs(datafolder, exist_ok=True)
+    # Up to 4 people per household
+    house_ids = 30000000 + np.arange(num_people) // 4
+    person_ids = np.arange(num_people) % 4 + 1
+    perpub = pd.DataFrame({"HOUSEID" : house_ids, "PERSONID" : person_ids,
+            "WORKER" : rng.choice([1, 2], num_people), "SCHTYP" : rng.choice([1, 2, 3], num_people),
+            "WTPERFIN" : rng.gamma(2.0, 500.0, num_people)})
+    add_filler_columns(perpub, filler_columns, rng).to_csv(datafolder + "perpub.csv", index=False)
+
+    trip_counts = rng.integers(2, 7, num_people)
+    num_trips = int(trip_counts.sum())
+    person = np.repeat(np.arange(num_people), trip_counts)
+    first = np.concatenate(([0], np.cumsum(trip_counts)[:-1]))
+    trip_number = np.arange(num_trips) - np.repeat(first, trip_counts) + 1
+    is_last = trip_number == np.repeat(trip_counts, trip_counts)
+    why_to = rng.choice(purposes, num_trips)
+    why_to[is_last] = 1
+    why_from = np.roll(why_to, 1)
+    why_from[trip_number == 1] = 1
+    # Some round trips from home, which get split in two
+    loop_trip = np.where((why_from == 1) & ~is_last & (rng.random(num_trips) < 0.1), 1, 2)
+    # Start times spread through the day, in HHMM
+    start_minutes = 300 + (trip_number - 1) * 150 + rng.integers(0, 120, num_trips)
+    durations = rng.integers(5, 60, num_trips)
+    end_minutes = (start_minutes + durations) % 1440
+    trippub = pd.DataFrame({"HOUSEID" : house_ids[person], "PERSONID" : person_ids[person],
+            "TDTRPNUM" : trip_number, "TRPMILES" : np.round(rng.exponential(6.0, num_trips) + 0.05, 3),
+            "TRPTRANS" : rng.choice(modes, num_trips), "WHYFROM" : why_from,
+            "LOOP_TRIP" : loop_trip, "WHYTO" : why_to,
+            "STRTTIME" : (start_minutes // 60) * 100 + start_minutes % 60,
+            "ENDTIME" : (end_minutes // 60) * 100 + end_minutes % 60})
+    # A few people with unsupported modes or empty trips to be filtered out
+    filtered = rng.random(num_trips) < 0.02
+    trippub.loc[filtered, "TRPTRANS"] = rng.choice([19, 20], int(filtered.sum()))
+    filtered = rng.random(num_trips) < 0.01
+    trippub.loc[filtered, "TRPMILES"] = -9
+    add_filler_columns(trippub, filler_columns, rng).to_csv(datafolder + "trippub.csv", index=False)
+
+def write_synthpop(datafolder, num_people, seed=0, filler_columns=20):
+    rng = np.random.default_rng(seed)
+    os.makedirs(datafolder, exist_ok=True)
+    person = pd.DataFrame({"ESR" : rng.choice([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, np.nan], num_people),
+            "SCH" : rng.choice([1.0, 2.0, 3.0, np.nan], num_people)})
+    add_filler_columns(person, filler_columns, rng).to_csv(datafolder + "person.csv", index=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, help="Directory to write the data folders in",
+        default=".")
+    parser.add_argument("--nhts_people", type=int, help="Number of NHTS people", default=100000)
+    parser.add_argument("--synthpop_people", type=int, help="Number of synthpop people",
+        default=100000)
+    parser.add_argument("--seed", type=int, help="Seed for the generated data", default=0)
+    args = parser.parse_args()
+    write_nhts(os.path.join(args.output_dir, "nhts-data/"), args.nhts_people, args.seed)
+    write_synthpop(os.path.join(args.output_dir, "synthpop-data/"), args.synthpop_people, args.seed)
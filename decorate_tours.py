@@ -1,10 +1,16 @@
 import numpy as np
-import requests
-import json
 from lxml import etree
-import xml.dom.minidom as minidom
-from scipy.spatial.distance import euclidean
 import time
+import collections
+import contextlib
+import gzip
+import hashlib
+import concurrent.futures
+import json
+import tour_io
+from location_cache import filter_to_box
+from metrics import metrics
+from overpass_client import OverpassClient, OverpassError
 
 
 query_template = "[out:json][timeout:25];\n(\n{});\nout body;\n>;"
@@ -70,8 +76,48 @@ search_map = {1 : home_searches, 2 : home_searches, 3 : work_searches,
         -7 : legal_searches, 97 : legal_searches}
 
 
-def append_trips(base, endpoints, tour):
-    person = etree.SubElement(base, 'person')
+@contextlib.contextmanager
+def open_population(output_file):
+    # Incremental writer for the <plans> document, gzipped if output_file
+    # ends in .gz. Produces the same bytes as pretty printing the whole tree.
+    if output_file.endswith(".gz"):
+        f = gzip.open(output_file, "wb")
+    else:
+        f = open(output_file, "wb")
+    with f:
+        with etree.xmlfile(f, encoding='utf8') as writer:
+            with writer.element('plans'):
+                writer.write("\n")
+                yield writer
+        f.write(b"\n")
+
+@contextlib.contextmanager
+def open_population_fragments(output_file):
+    # Same document as open_population, for writing already serialized
+    # persons from serialize_person
+    if output_file.endswith(".gz"):
+        f = gzip.open(output_file, "wb")
+    else:
+        f = open(output_file, "wb")
+    with f:
+        f.write(b"<plans>\n")
+        yield f
+        f.write(b"</plans>\n")
+
+def append_trips(writer, endpoints, tour):
+    # Writes the person straight to the open population file
+    with metrics.stage("serialize"):
+        writer.write("  ")
+        writer.write(build_person(endpoints, tour))
+        writer.flush()
+
+def serialize_person(endpoints, tour):
+    # The bytes append_trips writes for the person
+    with metrics.stage("serialize"):
+        return b"  " + etree.tostring(build_person(endpoints, tour), encoding='utf8')
+
+def build_person(endpoints, tour):
+    person = etree.Element('person')
     userid = list(tour.keys())[0]
     contents = tour[userid]
     is_student = "yes" if contents["student"] else "no"
@@ -100,27 +146,66 @@ def append_trips(base, endpoints, tour):
     action.set("lat", str(endpoint["lat"]))
     action.set("lon", str(endpoint["lon"]))
 
+    etree.indent(person, space="  ", level=1)
+    person.tail = "\n"
+    return person
+
 logging_file = None
 
-def decorate_tours(tour_json, output_file):
+def decorate_tours(tour_json, output_file, concurrency=1, seed=None, checkpoint=None,
+        resume=False, coalesce=1):
+    decorate_tour_stream(tour_io.read_tours(tour_json), output_file, concurrency, seed,
+            checkpoint, resume, coalesce)
+
+def decorate_tour_stream(tours, output_file, concurrency=1, seed=None, checkpoint=None,
+        resume=False, coalesce=1):
+    # tours can be any iterable, so decoration starts as soon as the first
+    # tour is available. checkpoint is an optional DecorationCheckpoint; with
+    # resume the tours it already holds are written out without being
+    # decorated again. With coalesce > 1 the location lookups of that many
+    # tours at a time are sent together.
+    decorated = []
+    if checkpoint is not None and resume:
+        checkpoint_seed = checkpoint.resume()
+        if seed is not None and seed != checkpoint_seed:
+            raise ValueError("The checkpoint was made with seed {}".format(checkpoint_seed))
+        seed = checkpoint_seed
+        decorated = checkpoint.get_endpoints()
+    elif seed is None and (concurrency > 1 or coalesce > 1 or checkpoint is not None
+            or decoration_store is not None):
+        # Tours finish in any order, are interleaved, may be resumed or are
+        # stored, so each needs its own random state
+        seed = np.random.SeedSequence().entropy
+        print("Used seed {}".format(seed))
+    if checkpoint is not None and not resume:
+        checkpoint.start(seed)
     home_options = get_home_locations()
-    plans = etree.Element('plans')
-    with open(tour_json, "r") as f:
-        tours = json.load(f)
-    with open("logs.txt", "w") as f:
+    if decoration_store is not None:
+        decoration_store.set_home_options(home_options)
+    failed = []
+    with open("logs.txt", "w") as f, open_population(output_file) as plans:
         global logging_file
         logging_file = f
-        for i, tour in enumerate(tours):
-            decorated_tour = decorate_tour(tour, home_options)
+        for i, tour, decorated_tour in decorate_in_order(tours, home_options, concurrency,
+                seed, decorated, coalesce=coalesce):
+            tour_id = list(tour.keys())[0]
+            if checkpoint is not None and i < len(decorated):
+                checkpoint.check(i, tour)
             if decorated_tour is None:
-                break
-            append_trips(plans, decorated_tour, tour)
-            print("On tour {} at time {}".format(i, time.time()), file=logging_file)
+                # Skip tours that can't be decorated instead of ending the run
+                failed.append({"index" : i, "tour" : tour_id})
+                metrics.count("failed_tours")
+                print("Skipping tour {} at time {}".format(i, time.time()), file=logging_file)
+            else:
+                append_trips(plans, decorated_tour, tour)
+            metrics.record_tour()
+            if checkpoint is not None and i >= len(decorated):
+                checkpoint.record(i, tour, decorated_tour)
             logging_file.flush()
-    xml_str = etree.tostring(plans, encoding='utf8', method='xml', pretty_print=True)
-    with open(output_file, "bw") as f:
-        f.write(xml_str)
-        f.flush()
+    if checkpoint is not None:
+        checkpoint.finish()
+    with open(output_file + ".failed.json", "w") as f:
+        json.dump(failed, f, indent=4)
 
     """
     distance_in_meters = 10000
@@ -131,18 +216,199 @@ def decorate_tours(tour_json, output_file):
         latitude + bbox_delta, longitude + bbox_delta, "building", "apartments"))
     """
 
+def decorate_in_order(tours, home_options, concurrency, seed, decorated=(), first_index=0,
+        coalesce=1):
+    # Yields (index, tour, endpoints) in the original tour order while up to
+    # concurrency groups of coalesce tours are decorated at once. The first
+    # tours reuse the endpoints in decorated instead. first_index is the index
+    # of the first tour within the whole run.
+    tours = iter(tours)
+    for i, tour in zip(range(len(decorated)), tours):
+        yield first_index + i, tour, decorated[i]
+    first_index += len(decorated)
+    groups = get_tour_groups(enumerate(tours, start=first_index), coalesce)
+    if concurrency <= 1:
+        for group in groups:
+            for (i, tour), endpoints in zip(group, decorate_group(group, home_options, seed)):
+                yield i, tour, endpoints
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = collections.deque()
+        try:
+            for group in groups:
+                future = executor.submit(decorate_group, group, home_options, seed)
+                pending.append((group, future))
+                # Only read ahead a little so memory stays bounded
+                if len(pending) >= 2 * concurrency:
+                    group, future = pending.popleft()
+                    for (i, tour), endpoints in zip(group, future.result()):
+                        yield i, tour, endpoints
+            while pending:
+                group, future = pending.popleft()
+                for (i, tour), endpoints in zip(group, future.result()):
+                    yield i, tour, endpoints
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def get_tour_groups(indexed_tours, size):
+    # Splits (index, tour) pairs into lists of up to size consecutive tours
+    group = []
+    for indexed_tour in indexed_tours:
+        group.append(indexed_tour)
+        if len(group) >= size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+def decorate_group(group, home_options, seed):
+    # Returns the endpoints of each (index, tour) in group, None for failures.
+    # Tours in decoration_store are reused instead of decorated again.
+    if decoration_store is None:
+        return decorate_new_group(group, home_options, seed)
+    keys = [get_tour_key(tour, seed, i) for i, tour in group]
+    results = decoration_store.get(keys)
+    missing = [k for k, endpoints in enumerate(results) if endpoints is None]
+    if missing:
+        decorated = decorate_new_group([group[k] for k in missing], home_options, seed)
+        decoration_store.put([keys[k] for k in missing], decorated)
+        for k, endpoints in zip(missing, decorated):
+            results[k] = endpoints
+    return results
+
+def decorate_new_group(group, home_options, seed):
+    if len(group) == 1:
+        i, tour = group[0]
+        return [try_decorate_tour(tour, home_options, get_tour_rng(seed, i))]
+    return decorate_batch(group, home_options, seed)
+
+def decorate_batch(group, home_options, seed):
+    # Decorates the tours in group in lockstep. Each round collects the next
+    # location lookup of every unfinished tour and answers them together
+    # with get_locations_for_searches, so a round costs one query instead of
+    # one per tour. Every tour still draws from its own random state in the
+    # same order, so the endpoints match decorating the tours one at a time
+    # with the same seed.
+    results = [None] * len(group)
+    steps = dict()
+    lookups = dict()
+    with metrics.stage("decorate"):
+        for k, (i, tour) in enumerate(group):
+            steps[k] = decorate_tour_steps(tour, home_options, get_tour_rng(seed, i))
+            try:
+                lookups[k] = next(steps[k])
+            except StopIteration as e:
+                results[k] = e.value
+        while lookups:
+            metrics.count("coalesced_rounds")
+            answers = get_locations_for_lookups(list(lookups.values()))
+            # A tour whose query failed is treated like one whose locations
+            # couldn't be found, the others carry on
+            for k, answer in zip(list(lookups), answers):
+                if isinstance(answer, OverpassError):
+                    print("Overpass failed for {}: {}".format(list(group[k][1].keys())[0], answer),
+                            file=logging_file)
+                    steps[k].close()
+                    del lookups[k]
+            answers = [answer for answer in answers if not isinstance(answer, OverpassError)]
+            choices = choose_locations(list(lookups.values()), answers)
+            for k, location in zip(list(lookups), choices):
+                try:
+                    lookups[k] = steps[k].send(location)
+                except StopIteration as e:
+                    results[k] = e.value
+                    del lookups[k]
+    return results
+
+def decorate_shard(tours, home_options, concurrency, seed, first_index, coalesce=1):
+    # Decorates a contiguous run of tours starting at tour first_index and
+    # returns the serialized persons and the failed tours
+    fragments = []
+    failed = []
+    for i, tour, decorated_tour in decorate_in_order(tours, home_options, concurrency, seed,
+            first_index=first_index, coalesce=coalesce):
+        if decorated_tour is None:
+            failed.append({"index" : i, "tour" : list(tour.keys())[0]})
+            metrics.count("failed_tours")
+            print("Skipping tour {} at time {}".format(i, time.time()), file=logging_file)
+        else:
+            fragments.append(serialize_person(decorated_tour, tour))
+        metrics.record_tour()
+    return b"".join(fragments), failed
+
+def try_decorate_tour(tour_dict, home_options, rng=np.random):
+    # A tour whose queries the server failed to answer is treated like one
+    # whose locations couldn't be found
+    try:
+        with metrics.stage("decorate"):
+            return decorate_tour(tour_dict, home_options, rng)
+    except OverpassError as e:
+        print("Overpass failed for {}: {}".format(list(tour_dict.keys())[0], e), file=logging_file)
+        return None
+
+# Optional decoration_store.DecorationStore to reuse endpoints from
+decoration_store = None
+
+# Bump this whenever a change to decoration changes the endpoints a tour
+# gets, so stored endpoints aren't reused
+DECORATION_VERSION = 1
+
+def get_tour_key(tour_dict, seed, tour_index):
+    # Hash of everything that decides a tour's endpoints
+    plan = list(tour_dict.values())[0]['plan']
+    # Every tour looks up a work location
+    dests = sorted(set(action['dest_encoding'] for action in plan) | {3})
+    content = {"version" : DECORATION_VERSION, "plan" : plan,
+            "searches" : {str(dest) : search_map.get(dest) for dest in dests},
+            "seed" : seed, "index" : tour_index, "home" : decoration_store.home_key,
+            "closest_candidates" : closest_candidates}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def get_tour_rng(seed, tour_index):
+    # Every tour gets a random state derived from the run seed and its index,
+    # so its decoration doesn't depend on which other tours ran before it
+    if seed is None:
+        return np.random
+    seed_sequence = np.random.SeedSequence(seed, spawn_key=(tour_index,))
+    return np.random.RandomState(np.random.MT19937(seed_sequence))
+
 miles2meter = 1609.34
 meter2deg = 90/(10001.965729 * 1000)
-def decorate_tour(tour_dict, home_options):
+# Locations are picked at random from this many of the candidates closest
+# to the target distance. 1 always picks the closest.
+closest_candidates = 1
+
+# decorate_tour, generate_data and get_work_location are driven by the
+# *_steps generators below. Each yields the location lookups it needs as
+# (min_lat, min_lon, max_lat, max_lon, searches, lat, lon, target_distance,
+# draw) and is sent back the chosen location in the box, or None if the box
+# is empty, so lookups from many tours can be answered together by
+# decorate_batch.
+
+def run_lookups(steps):
+    # Answers each lookup of a steps generator directly and returns its result
+    try:
+        lookup = next(steps)
+        while True:
+            locations = get_locations_in_box(*lookup[:5])
+            lookup = steps.send(choose_locations([lookup], [locations])[0])
+    except StopIteration as e:
+        return e.value
+
+def decorate_tour(tour_dict, home_options, rng=np.random):
+    return run_lookups(decorate_tour_steps(tour_dict, home_options, rng))
+
+def decorate_tour_steps(tour_dict, home_options, rng=np.random):
 
-    home = get_home_location(home_options)
+    home = get_home_location(home_options, rng)
     endpoints = [home]
     current_location = home
     
     userid = list(tour_dict.keys())[0]
     plan = tour_dict[userid]['plan']
 
-    work = get_work_location(plan, home)
+    work = yield from get_work_location_steps(plan, home, rng)
     for action in plan:
         dest = action['dest_encoding']
         if dest == 1 or dest == 2:
@@ -153,7 +419,7 @@ def decorate_tour(tour_dict, home_options):
                 # Convert the data into a larger bounding box containing the four corners
                 target_dist = dist_miles * miles2meter * meter2deg
                 lat, lon = current_location['lat'], current_location['lon']
-                work = generate_data (dest, lat, lon, target_dist)
+                work = yield from generate_data_steps(dest, lat, lon, target_dist, rng)
             current_location = work
             if current_location is None:
                 return None
@@ -162,13 +428,16 @@ def decorate_tour(tour_dict, home_options):
             # Convert the data into a larger bounding box containing the four corners
             target_dist = dist_miles * miles2meter * meter2deg
             lat, lon = current_location['lat'], current_location['lon']
-            current_location = generate_data (dest, lat, lon, target_dist)
+            current_location = yield from generate_data_steps(dest, lat, lon, target_dist, rng)
             if current_location is None:
                 return None
         endpoints.append(current_location)
     return endpoints
 
-def generate_data(dest, lat, lon, target_distance):
+def generate_data(dest, lat, lon, target_distance, rng=np.random):
+    return run_lookups(generate_data_steps(dest, lat, lon, target_distance, rng))
+
+def generate_data_steps(dest, lat, lon, target_distance, rng=np.random):
     offset = target_distance * 2
     expand_search = True
     while expand_search:
@@ -177,43 +446,65 @@ def generate_data(dest, lat, lon, target_distance):
             expand_search = False
             # We will now always advance the target distance. Sample
             # a random direction.
-            angle = np.random.uniform(low=0.0, high=(2.0 * np.pi))
+            angle = rng.uniform(low=0.0, high=(2.0 * np.pi))
             lat_change = np.cos(angle) * target_distance
-            lon_change = np.sin(angle) * target_distance
+            lon_change = np.sin(angle) * target_distance / np.cos(np.radians(lat))
             current_location = dict()
             current_location['lat'] = lat + lat_change
             current_location['lon'] = lon + lon_change
 
         else:
-            locations = get_locations_in_box(lat - offset, lon - offset, 
-                    lat + offset, lon + offset, search_map[dest])
-            expand_search = len(locations) == 0
-            if not expand_search:
-                current_location = get_closest_to_target(lat, lon, target_distance, locations)
-            elif offset > 2500:
+            metrics.count("location_queries", label=why_map[dest])
+            draw = rng.random_sample() if closest_candidates > 1 else 0.0
+            current_location = yield (lat - offset, lon - offset, lat + offset, lon + offset,
+                    search_map[dest], lat, lon, target_distance, draw)
+            expand_search = current_location is None
+            if expand_search and offset > 2500:
                 # The limit through the OSM API is 25 degrees, so set an out involving retrying when
+                metrics.count("searches_given_up", label=why_map[dest])
                 return None
-            else:
-                print("Need to repeat the search at time : {}.".format(time.time()), file=logging_file)
-                print("Issue with search at location:({}, {}) with query set {}".format(lat, lon, search_map[dest]), file=logging_file)
-                print("Offset is {}".format(offset), file=logging_file)
-                print("Destination type is {}".format(dest), file=logging_file)
+            elif expand_search:
+                metrics.count("offset_expansions", label=why_map[dest])
                 offset *= 1.5
     return current_location
 
-def get_closest_to_target(lat, lon, target_dist, locations):
-    old_loc = np.array([lat, lon])
-    min_value = float('inf')
-    loc_choice = None
-    for loc in locations:
-        target_loc = np.array([loc['lat'], loc['lon']])
-        distance = np.absolute(euclidean(old_loc, target_loc) - target_dist)
-        if distance < min_value:
-            min_value = distance
-            loc_choice = loc
-    return loc_choice
-
-def get_work_location(plan, home):
+def get_closest_to_target(lat, lon, target_dist, locations, draw=0.0):
+    return choose_locations([(lat, lon, target_dist, draw)], [locations], lookup_start=0)[0]
+
+def choose_locations(lookups, answers, lookup_start=5):
+    # Picks a location for every lookup from its answer at once. Each lookup
+    # holds (lat, lon, target_distance, draw) from lookup_start on. Distances
+    # are in degrees of latitude, with longitudes scaled by the cosine of the
+    # starting latitude so east-west distances aren't overstated. Candidates
+    # are ranked by how far their distance is from the target, ties keeping
+    # their original order, and draw in [0, 1) picks among the best
+    # closest_candidates of them. Lookups with no candidates get None.
+    counts = np.array([len(locations) for locations in answers], dtype=np.int64)
+    if counts.sum() == 0:
+        return [None] * len(answers)
+    lookup_values = np.array([lookup[lookup_start:lookup_start + 4] for lookup in lookups],
+            dtype=np.float64).reshape(-1, 4)
+    candidates = np.array([(loc['lat'], loc['lon']) for locations in answers for loc in locations],
+            dtype=np.float64)
+    segments = np.repeat(np.arange(len(answers)), counts)
+    lat, lon, target_dist, draw = lookup_values[segments].T
+    lat_diff = candidates[:, 0] - lat
+    lon_diff = (candidates[:, 1] - lon) * np.cos(np.radians(lat))
+    error = np.abs(np.hypot(lat_diff, lon_diff) - target_dist)
+    # Sort by lookup, then error. lexsort is stable, so ties keep their order.
+    order = np.lexsort((error, segments))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    top = np.minimum(counts, closest_candidates)
+    picks = starts + (lookup_values[:, 3] * top).astype(np.int64)
+    chosen = []
+    for j, locations in enumerate(answers):
+        chosen.append(locations[order[picks[j]] - starts[j]] if counts[j] > 0 else None)
+    return chosen
+
+def get_work_location(plan, home, rng=np.random):
+    return run_lookups(get_work_location_steps(plan, home, rng))
+
+def get_work_location_steps(plan, home, rng=np.random):
     home_values = [1, 2]
     prev = 1
     for action in plan:
@@ -223,7 +514,7 @@ def get_work_location(plan, home):
             lat, lon = home['lat'], home['lon']
             # Convert the data into a larger bounding box containing the four corners
             target_dist = dist_miles * miles2meter * meter2deg
-            return generate_data(3, lat, lon, target_dist)
+            return (yield from generate_data_steps(3, lat, lon, target_dist, rng))
         prev = dest
     return None
 
@@ -234,49 +525,91 @@ def get_home_locations():
     return get_locations_in_box(min_lat, min_lon, max_lat, max_lon, home_searches)
 
 
-def get_home_location(options):
-    index = np.random.randint(len(options))
+def get_home_location(options, rng=np.random):
+    index = rng.randint(len(options))
     return options[index]
     
 
+# Object answering get_locations_in_box queries instead of Overpass, such as
+# an osm_index.OSMIndex. None sends the queries to overpass_url.
+location_backend = None
+
+def get_search_tags():
+    # Every (key, value) tag that a location query can ask for
+    tags = set(home_searches)
+    for searches in search_map.values():
+        tags.update(searches)
+    return tags
+
 def get_locations_in_box(min_lat, min_lon, max_lat, max_lon, searches):
-    min_waiting_time = 5
+    if location_backend is not None:
+        return location_backend.get_locations_in_box(min_lat, min_lon, max_lat, max_lon, searches)
+    return get_overpass_locations_in_box(min_lat, min_lon, max_lat, max_lon, searches)
+
+def get_locations_for_searches(box_searches):
+    # Returns the locations in each (box, searches) pair. An OverpassError
+    # takes the place of the locations of pairs whose query failed.
+    if location_backend is not None:
+        if hasattr(location_backend, "get_locations_for_searches"):
+            return location_backend.get_locations_for_searches(box_searches)
+        return [location_backend.get_locations_in_box(*box, searches)
+                for box, searches in box_searches]
+    return get_overpass_locations_for_searches(box_searches)
+
+def get_locations_for_lookups(lookups):
+    # Finds the locations in the box of every lookup, whatever its searches,
+    # with one get_locations_for_searches call
+    metrics.count("coalesced_lookups", len(lookups))
+    try:
+        return get_locations_for_searches([(lookup[:4], lookup[4]) for lookup in lookups])
+    except OverpassError as e:
+        # A backend that doesn't split failures up by query fails them all
+        return [e] * len(lookups)
+
+# Client used for Overpass queries, created for overpass_url when first needed
+overpass_client = None
+
+def get_overpass_client():
+    global overpass_client
+    if overpass_client is None:
+        overpass_client = OverpassClient(overpass_url)
+    return overpass_client
+
+def get_overpass_locations_in_box(min_lat, min_lon, max_lat, max_lon, searches):
     bbox_string = "%s,%s,%s,%s" % (min_lat, min_lon, max_lat, max_lon)
     node_searches = [node_template.format(elem[0], elem[1], bbox=bbox_string) for elem in searches]
     combined_nodes = "".join(node_searches)
     overpass_query = query_template.format(combined_nodes)
-    response = requests.post(overpass_url + "api/interpreter", data=overpass_query)
-    try:
-        all_results = response.json()["elements"]
-    except json.decoder.JSONDecodeError as e:
-        time.sleep(5)
-        response = requests.post(overpass_url + "api/interpreter", data=overpass_query)
-    try:
-        all_results = response.json()["elements"]
-    except json.decoder.JSONDecodeError as e:
-        if response.status_code == 429:
-            response = requests.get(overpass_url + "api/status")
-            status_string = response.text.split("\n")
-            try:
-                available_slots = int(status_string[3].split(" ")[0])
-                if available_slots > 0:
-                    response = requests.post(overpass_url + "api/interpreter", data=overpass_query)
-                    all_results = response.json()["elements"]
-                # Some api/status returns 0 slots available and then when they will be available
-                elif available_slots == 0:
-                    min_waiting_time = min(int(status_string[4].split(" ")[5]), int(status_string[5].split(" ")[5]))
-                    time.sleep(min_waiting_time)
-                    response = requests.post(overpass_url + "api/interpreter", data=overpass_query)
-                    all_results = response.json()["elements"]
-            except ValueError as e:
-                # And some api/status directly returns when the slots will be available
-                try:
-                    min_waiting_time = min(int(status_string[3].split(" ")[5]), int(status_string[4].split(" ")[5]))
-                    time.sleep(min_waiting_time)
-                    response = requests.post(overpass_url + "api/interpreter", data=overpass_query)
-                    all_results = response.json()["elements"]
-                except ValueError as e:
-                    all_results = []
-        else:
-            all_results = []
-    return all_results
+    return get_overpass_client().query(overpass_query)
+
+# Most boxes to put in one Overpass query, since the server's time and memory
+# limits apply to the whole query
+max_boxes_per_query = 50
+
+def get_overpass_locations_for_searches(box_searches):
+    # Sends the searches of every (box, searches) pair as one query and splits
+    # the answer back up by box and by tag. Overpass sorts the nodes it
+    # outputs by id, so each pair gets the same list a query for just that
+    # box and those searches would have returned. Pairs whose query failed
+    # get the OverpassError instead.
+    results = []
+    for start in range(0, len(box_searches), max_boxes_per_query):
+        query_searches = box_searches[start:start + max_boxes_per_query]
+        # The same tag in the same box only needs one clause
+        node_searches = collections.OrderedDict(
+                (node_template.format(elem[0], elem[1], bbox="%s,%s,%s,%s" % tuple(box)), None)
+                for box, searches in query_searches for elem in searches)
+        overpass_query = query_template.format("".join(node_searches))
+        try:
+            elements = get_overpass_client().query(overpass_query)
+        except OverpassError as e:
+            results.extend([e] * len(query_searches))
+            continue
+        results.extend(filter_to_searches(filter_to_box(elements, *box), searches)
+                for box, searches in query_searches)
+    return results
+
+def filter_to_searches(elements, searches):
+    # The elements tagged with any of searches
+    return [elem for elem in elements
+            if any(elem["tags"].get(key) == value for key, value in searches)]
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+
+# Periodic checkpoints of a decoration run so it can be resumed after a
+# crash. Every decorated tour is appended to decorated.jsonl (failed tours
+# with null endpoints) and every `every` tours checkpoint.json records how
+# much of that file is complete together with the run's seed. Tours draw
+# from random states derived from the seed and their index, so the seed is
+# all of the random state a resumed run needs. Each line also holds a hash
+# of the tour's plan so a resumed run can tell it is given the same tours.
+
+class DecorationCheckpoint:
+
+    def __init__(self, checkpoint_dir, every=100):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.results_file = os.path.join(checkpoint_dir, "decorated.jsonl")
+        self.state_file = os.path.join(checkpoint_dir, "checkpoint.json")
+        self.every = every
+        self.seed = None
+        self.results = []
+        self.completed = 0
+        self.f = None
+
+    def start(self, seed):
+        self.seed = seed
+        self.results = []
+        self.completed = 0
+        self.f = open(self.results_file, "w")
+        self.save()
+
+    def resume(self):
+        # Loads the tours completed as of the last checkpoint, drops anything
+        # written after it and returns the run's seed
+        with open(self.state_file, "r") as f:
+            state = json.load(f)
+        self.seed = state["seed"]
+        self.f = open(self.results_file, "r+")
+        self.f.truncate(state["results_bytes"])
+        self.results = [json.loads(line) for line in self.f]
+        self.completed = len(self.results)
+        if self.completed != state["completed"]:
+            raise ValueError("{} doesn't match {}".format(self.results_file, self.state_file))
+        return self.seed
+
+    def get_endpoints(self):
+        return [result["endpoints"] for result in self.results]
+
+    def check(self, index, tour):
+        # Raises if tour isn't the tour that was decorated at index
+        tour_id, tour_info = next(iter(tour.items()))
+        result = self.results[index]
+        if result["tour"] != tour_id or result.get("plan") != get_plan_hash(tour_info["plan"]):
+            raise ValueError("{} at index {} doesn't match {} in {}, the tours changed since the"
+                    " checkpoint".format(tour_id, index, result["tour"], self.results_file))
+
+    def record(self, index, tour, endpoints):
+        tour_id, tour_info = next(iter(tour.items()))
+        self.f.write(json.dumps({"index" : index, "tour" : tour_id,
+                "plan" : get_plan_hash(tour_info["plan"]), "endpoints" : endpoints}))
+        self.f.write("\n")
+        self.completed += 1
+        if self.completed % self.every == 0:
+            self.save()
+
+    def save(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        state = {"completed" : self.completed, "results_bytes" : self.f.tell(), "seed" : self.seed}
+        with open(self.state_file + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def finish(self):
+        self.save()
+        self.f.close()
+
+def get_plan_hash(plan):
+    return hashlib.sha1(json.dumps(plan, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from metrics import metrics
+
+# Decorated endpoints kept across runs under a hash of everything that
+# decides them: the tour's plan, the searches of the categories it visits,
+# the run seed and tour index its random state comes from and the home
+# locations. A re-run only decorates the tours whose hash isn't stored yet,
+# so regenerating tours or editing one category only costs the lookups of
+# the tours that actually changed. Failed tours aren't stored so they are
+# retried.
+
+class DecorationStore:
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.home_key = None
+        self.reopen()
+
+    def reopen(self):
+        # SQLite connections can't be used across a fork
+        self.lock = threading.RLock()
+        # Other processes may write to the same file, so wait for their locks
+        self.db = sqlite3.connect(self.store_file, timeout=60, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS decorations (key TEXT PRIMARY KEY,"
+                " endpoints TEXT)")
+        self.db.commit()
+
+    def set_home_options(self, home_options):
+        # Tours pick their home from these, so they are part of every key
+        self.home_key = hashlib.sha1(json.dumps(home_options, sort_keys=True).encode()).hexdigest()
+
+    def get(self, keys):
+        # Stored endpoints for each key, None for keys that aren't stored
+        with self.lock:
+            stored = dict()
+            for key in keys:
+                row = self.db.execute("SELECT endpoints FROM decorations WHERE key = ?",
+                        (key,)).fetchone()
+                if row is not None:
+                    stored[key] = json.loads(row[0])
+        metrics.count("decoration_store", len(stored), label="hit")
+        metrics.count("decoration_store", len(keys) - len(stored), label="miss")
+        return [stored.get(key) for key in keys]
+
+    def put(self, keys, endpoints):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO decorations VALUES (?, ?)",
+                    [(key, json.dumps(tour_endpoints)) for key, tour_endpoints in zip(keys, endpoints)
+                        if tour_endpoints is not None])
+            self.db.commit()
+
+    def report(self):
+        # From the metrics, which include the counts of worker processes
+        counters = metrics.summary()["counters"]
+        return "Decoration store: {} tours reused, {} decorated".format(
+                counters.get("decoration_store[hit]", 0), counters.get("decoration_store[miss]", 0))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,18 +1,92 @@
 import pandas as pd
 import numpy as np
-import scipy.stats as stats
+import hashlib
+import json
+import os
+from metrics import metrics, get_peak_rss
+
+# Bump this whenever the filtering or splitting in NHTS_Data.load_nhts_data
+# changes so that stale caches are rebuilt instead of loaded.
+FILTER_VERSION = 5
+
+# The only columns read from the nhts csvs, with the narrowest types that
+# hold their values. Times are HHMM integers and the codes are all small.
+perpub_dtypes = {"HOUSEID" : np.int64, "PERSONID" : np.int8, "WORKER" : np.int8,
+        "SCHTYP" : np.int8, "WTPERFIN" : np.float32}
+trippub_dtypes = {"HOUSEID" : np.int64, "PERSONID" : np.int8, "TDTRPNUM" : np.int16,
+        "TRPMILES" : np.float32, "TRPTRANS" : np.int8, "WHYFROM" : np.int8,
+        "LOOP_TRIP" : np.int8, "WHYTO" : np.int8, "STRTTIME" : np.int16, "ENDTIME" : np.int16}
 
 class NHTS_Data:
 
-    def __init__(self):
+    def __init__(self, datafolder="nhts-data/", use_cache=True, rebuild_cache=False,
+            use_weights=False):
         # Find the paths to all the nhts provided data
-        datafolder = "nhts-data/"
         perpub_file = datafolder + "perpub.csv"
         trippub_file = datafolder + "trippub.csv"
+        cache_folder = datafolder + "cache/"
+
+        cache_key = None
+        df_total = None
+        if use_cache:
+            cache_key = get_cache_key([perpub_file, trippub_file], cache_folder)
+            if not rebuild_cache:
+                with metrics.stage("load_cache"):
+                    df_total = load_cache(cache_folder, cache_key)
+        if df_total is None:
+            df_total = self.load_nhts_data(perpub_file, trippub_file)
+            if use_cache:
+                with metrics.stage("write_cache"):
+                    write_cache(cache_folder, cache_key, df_total)
+        # Save the remainder for querying
+        self.nhts_data = df_total
+        metrics.count("nhts_memory_bytes", int(df_total.memory_usage(deep=True).sum()))
+        with metrics.stage("index"):
+            self.build_user_index()
+            self.build_user_samplers(use_weights)
+
+    def build_user_index(self):
+        # nhts_data is sorted by (USERID, TDTRPNUM), so each user's trips are
+        # the contiguous rows user_offsets[i]:user_offsets[i + 1]
+        user_col = self.nhts_data["USERID"].to_numpy()
+        starts = np.flatnonzero(user_col[1:] != user_col[:-1]) + 1
+        self.user_offsets = np.concatenate(([0], starts, [len(user_col)]))
+        self.user_ids = user_col[self.user_offsets[:-1]]
+
+    def build_user_samplers(self, use_weights):
+        # Build one sampler per (is_student, is_worker) stratum. Student and
+        # worker status are per person, so they are read from each user's
+        # first trip.
+        student_encodings = [1, 2]
+        worker_encodings = [1]
+        first_rows = self.nhts_data.iloc[self.user_offsets[:-1]]
+        is_student = first_rows.SCHTYP.isin(student_encodings).to_numpy()
+        is_worker = first_rows.WORKER.isin(worker_encodings).to_numpy()
+        user_strata = get_strata(is_student, is_worker)
+        weights = first_rows.WTPERFIN.to_numpy(dtype=np.float64) if use_weights else None
+
+        all_users = np.arange(self.user_ids.shape[0])
+        self.user_samplers = []
+        for stratum in range(4):
+            stratum_users = np.flatnonzero(user_strata == stratum)
+            if stratum_users.shape[0] == 0:
+                # Nobody in the survey matches, so fall back to everyone
+                stratum_users = all_users
+            stratum_weights = None if weights is None else weights[stratum_users]
+            self.user_samplers.append(AliasSampler(stratum_users, stratum_weights))
 
+    def load_nhts_data(self, perpub_file, trippub_file):
         # Load all of the raw data
-        perpub_df = pd.read_csv(perpub_file)
-        trippub_df = pd.read_csv(trippub_file)
+        with metrics.stage("load"):
+            perpub_df = pd.read_csv(perpub_file, usecols=list(perpub_dtypes), dtype=perpub_dtypes)
+            trippub_df = pd.read_csv(trippub_file, usecols=list(trippub_dtypes),
+                    dtype=trippub_dtypes)
+        with metrics.stage("filter"):
+            df_total = self.filter_nhts_data(perpub_df, trippub_df)
+        metrics.count("nhts_load_peak_rss_bytes", get_peak_rss())
+        return df_total
+
+    def filter_nhts_data(self, perpub_df, trippub_df):
 
         # Filter perpub to only include the data possibly relevant to our parameters
         # HOUSEID = household label
@@ -34,9 +108,10 @@ class NHTS_Data:
         # HHSIZE = Household size
         # R_AGE_IMP = Person age
         # WORKER = Are tehy a worker? 1 = Yes, 2 = No
+        # WTPERFIN = Final person weight
 
-        kept_columns = ["HOUSEID", "PERSONID", "WORKER", "SCHTYP"]
-        perpub_df_reduced = perpub_df[kept_columns]
+        kept_columns = ["HOUSEID", "PERSONID", "WORKER", "SCHTYP", "WTPERFIN"]
+        perpub_df_reduced = perpub_df[kept_columns].astype(perpub_dtypes)
 
         # Filter trippub to only include the data possibly relevant to our parameters
         # HOUSEID = household label
@@ -51,10 +126,13 @@ class NHTS_Data:
         # WHYTO trip destination purpose
         # LOOP_TRIP = Are the start and end locations the same? 1 = Yes, 2 = No
         kept_columns = ["HOUSEID", "PERSONID", "TDTRPNUM", "TRPMILES", "TRPTRANS", "WHYFROM", "LOOP_TRIP", "WHYTO", "STRTTIME", "ENDTIME"]
-        trippub_df_reduced = trippub_df[kept_columns]
+        trippub_df_reduced = trippub_df[kept_columns].astype(trippub_dtypes)
 
         df_total = pd.merge(perpub_df_reduced, trippub_df_reduced, on=["HOUSEID","PERSONID"])
-        df_total["USERID"] = df_total["HOUSEID"].astype(str) + df_total["PERSONID"].astype(str)
+        # Integer key for each person. PERSONID is below 100, so unlike
+        # joining the two as strings every person gets a distinct key.
+        df_total["USERID"] = df_total["HOUSEID"].to_numpy(dtype=np.int64) * 100 + df_total["PERSONID"]
+        df_total = df_total.drop(columns=["HOUSEID", "PERSONID"])
 
         # Find IDS to remove with unsupported trips
         untracked_modes = [19, 20]
@@ -91,78 +169,225 @@ class NHTS_Data:
         df_total = df_total[~df_total.USERID.isin(ids_to_remove)]
 
         # Convert round trips to 2 trips
-        df_total.reset_index(inplace=True, drop=True)
-        spare_rows = []
-        for i in range(len(df_total.index)):
-            if (df_total.at[i, "LOOP_TRIP"] == 1):
-                df_total.at[i, "TRPMILES"] = df_total.at[i, "TRPMILES"] / 2.0
-                spare_row = df_total.iloc[i,:].copy(deep=True)
-                # Swap from and to
-                spare_row["WHYTO"], spare_row["WHYFROM"]  = spare_row["WHYFROM"], spare_row["WHYTO"]
-                # Increase the trip number
-                spare_row['TDTRPNUM'] = spare_row['TDTRPNUM'] + 0.5
-
-                # Get a new end time and start time
-                start_time = spare_row["STRTTIME"]
-                end_time = spare_row["ENDTIME"]
-                hour_diff = ((end_time // 100) - (start_time // 100))
-                if hour_diff < 0:
-                    hour_diff = 23 - hour_diff
-                minute_diff = (hour_diff % 2) * 30
-                hour_diff = (hour_diff // 2)
-                minute_diff += ((end_time % 100) - (start_time % 100))
-                new_minutes = (start_time % 100) + minute_diff
-                if new_minutes > 59:
-                    hour_carry = 1
-                    new_minutes = new_minutes - 59
-                else:
-                    hour_carry = 0
-                    if new_minutes < 0:
-                        new_minutes = new_minutes + 59
-                new_hour = ((start_time // 100) + hour_carry + hour_diff) % 24
-                final_time = new_hour * 100 + new_minutes
-                df_total.at[i, "ENDTIME"] = final_time
-                spare_row["STRTIME"] = new_hour * 100 + new_minutes
-
-                spare_rows.append(spare_row)
-        df_total = df_total.append(spare_rows, ignore_index=True)
-        # Save the remainder for querying
-        self.nhts_data = df_total
+        df_total = split_round_trips(df_total)
+
+        # Group each user's trips together in order for build_user_index
+        df_total = df_total.sort_values(["USERID", "TDTRPNUM"], kind="mergesort")
+        return df_total.reset_index(drop=True)
+
+    def get_users_rows(self, user_indices):
+        # Row positions of every trip of every user in user_indices, in
+        # order, plus offsets marking where each user's trips start
+        starts = self.user_offsets[user_indices]
+        lengths = self.user_offsets[user_indices + 1] - starts
+        tour_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        rows = np.arange(tour_offsets[-1]) + np.repeat(starts - tour_offsets[:-1], lengths)
+        return rows, tour_offsets
+
+    def get_user_trips(self, user_index):
+        start, end = self.user_offsets[user_index], self.user_offsets[user_index + 1]
+        return self.nhts_data.iloc[start:end].reset_index(drop=True)
 
-    # TODO add a way to filter
     def sample_tour(self, is_student, is_worker):
-        user_id = self.sample_user(is_student, is_worker)
-        user_df = self.nhts_data[self.nhts_data.USERID == user_id].sort_values('TDTRPNUM', ascending=True).reset_index(drop=True)
-        return user_df
+        user_index = self.sample_user_index(is_student, is_worker)
+        return self.get_user_trips(user_index)
 
-    # TODO add a way to filter
     def sample_user(self, is_student, is_worker):
-        student_encodings = [1, 2]
-        worker_encodings = [1]
-        student_op = 0 if is_student else 1
-        worker_op = 0 if is_worker else 1
+        return self.user_ids[self.sample_user_index(is_student, is_worker)]
+
+    def sample_user_index(self, is_student, is_worker):
+        return self.user_samplers[get_strata(is_student, is_worker)].sample()
+
+    def sample_users(self, strata):
+        return self.user_ids[self.sample_user_indices(strata)]
 
-        sample_data = self.nhts_data[((student_op) ^ (self.nhts_data.SCHTYP.isin(student_encodings))) 
-            & ((worker_op) ^ (self.nhts_data.WORKER.isin(worker_encodings)))]
-        user_ids = self.nhts_data.USERID.unique()
-        upper_bound = user_ids.shape[0]
-        return user_ids[np.random.randint(upper_bound)]
+    def sample_user_indices(self, strata):
+        # strata is an array of stratum codes from get_strata, or an
+        # (n, 2) array of (is_student, is_worker) pairs
+        strata = np.asarray(strata)
+        if strata.ndim == 2:
+            strata = get_strata(strata[:, 0], strata[:, 1])
+        user_indices = np.empty(strata.shape[0], dtype=np.int64)
+        for stratum, sampler in enumerate(self.user_samplers):
+            in_stratum = strata == stratum
+            user_indices[in_stratum] = sampler.sample(int(np.count_nonzero(in_stratum)))
+        return user_indices
+
+def get_strata(is_student, is_worker):
+    # Stratum code for the student/worker combination, from 0 to 3
+    return np.asarray(is_student, dtype=np.int64) * 2 + np.asarray(is_worker, dtype=np.int64)
+
+class AliasSampler:
+
+    # Walker's alias method. Draws one of values in O(1) time, uniformly
+    # if no weights are given.
+    def __init__(self, values, weights=None):
+        self.values = np.asarray(values)
+        self.prob = None
+        self.alias = None
+        if weights is None:
+            return
+        count = self.values.shape[0]
+        prob = np.asarray(weights, dtype=np.float64) * count / np.sum(weights)
+        alias = np.arange(count)
+        small = list(np.flatnonzero(prob < 1.0))
+        large = list(np.flatnonzero(prob >= 1.0))
+        while small and large:
+            less, more = small.pop(), large.pop()
+            alias[less] = more
+            prob[more] = prob[more] + prob[less] - 1.0
+            if prob[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left only differs from 1 by rounding error
+        prob[small + large] = 1.0
+        self.prob = prob
+        self.alias = alias
+
+    def sample(self, size=None):
+        choice = np.random.randint(self.values.shape[0], size=size)
+        if self.prob is not None:
+            keep = np.random.random_sample(size) < self.prob[choice]
+            choice = np.where(keep, choice, self.alias[choice])
+        return self.values[choice]
+
+def split_round_trips(df_total):
+    # Every round trip becomes an outbound trip that ends at the midpoint
+    # time and a mirrored return trip that starts there, each with half the
+    # distance. The mirrored rows are appended after all of the originals.
+    df_total = df_total.reset_index(drop=True)
+    is_loop = (df_total["LOOP_TRIP"] == 1).to_numpy()
+    df_total["TRPMILES"] = np.where(is_loop, df_total["TRPMILES"] / 2.0, df_total["TRPMILES"])
+    spare_rows = df_total[is_loop].copy()
+    # Swap from and to
+    spare_rows["WHYTO"] = df_total.loc[is_loop, "WHYFROM"].to_numpy()
+    spare_rows["WHYFROM"] = df_total.loc[is_loop, "WHYTO"].to_numpy()
+    # Increase the trip number
+    df_total["TDTRPNUM"] = df_total["TDTRPNUM"].astype(np.float32)
+    spare_rows["TDTRPNUM"] = spare_rows["TDTRPNUM"].astype(np.float32) + np.float32(0.5)
+
+    # Get a new end time and start time
+    start_time = spare_rows["STRTTIME"].to_numpy()
+    end_time = spare_rows["ENDTIME"].to_numpy()
+    hour_diff = (end_time // 100) - (start_time // 100)
+    hour_diff = np.where(hour_diff < 0, 23 - hour_diff, hour_diff)
+    minute_diff = (hour_diff % 2) * 30
+    hour_diff = hour_diff // 2
+    minute_diff += (end_time % 100) - (start_time % 100)
+    new_minutes = (start_time % 100) + minute_diff
+    hour_carry = (new_minutes > 59).astype(new_minutes.dtype)
+    new_minutes = np.where(new_minutes > 59, new_minutes - 59,
+            np.where(new_minutes < 0, new_minutes + 59, new_minutes))
+    new_hour = ((start_time // 100) + hour_carry + hour_diff) % 24
+    final_time = (new_hour * 100 + new_minutes).astype(end_time.dtype)
+    df_total.loc[is_loop, "ENDTIME"] = final_time
+    spare_rows["STRTTIME"] = final_time
+
+    return pd.concat([df_total, spare_rows], ignore_index=True)
+
+def hash_file(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def get_cache_key(source_files, cache_folder):
+    # The key is the size, mtime and hash of every source file plus the
+    # filter version. Hashing the csvs is the slow part, so reuse the hash
+    # recorded in an existing cache when the size and mtime still match.
+    old_sources = dict()
+    meta_file = cache_folder + "meta.json"
+    if os.path.exists(meta_file):
+        with open(meta_file, "r") as f:
+            old_sources = json.load(f)["key"]["sources"]
+    sources = dict()
+    for path in source_files:
+        stat = os.stat(path)
+        source = {"size" : stat.st_size, "mtime" : stat.st_mtime_ns}
+        old_source = old_sources.get(os.path.basename(path))
+        if (old_source is not None and old_source["size"] == source["size"]
+                and old_source["mtime"] == source["mtime"]):
+            source["sha1"] = old_source["sha1"]
+        else:
+            source["sha1"] = hash_file(path)
+        sources[os.path.basename(path)] = source
+    return {"filter_version" : FILTER_VERSION, "sources" : sources}
+
+def same_key(key, other_key):
+    # Mtimes are only used to skip rehashing, so a file that was touched
+    # but not changed still matches.
+    if key["filter_version"] != other_key["filter_version"]:
+        return False
+    if key["sources"].keys() != other_key["sources"].keys():
+        return False
+    for name, source in key["sources"].items():
+        other_source = other_key["sources"][name]
+        if (source["size"] != other_source["size"]
+                or source["sha1"] != other_source["sha1"]):
+            return False
+    return True
+
+def load_cache(cache_folder, cache_key):
+    # Each column is stored as its own .npy file so it can be memory mapped
+    meta_file = cache_folder + "meta.json"
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, "r") as f:
+        meta = json.load(f)
+    if not same_key(cache_key, meta["key"]):
+        return None
+    columns = dict()
+    for column in meta["columns"]:
+        columns[column] = np.load(cache_folder + column + ".npy", mmap_mode="r")
+    if cache_key != meta["key"]:
+        # Record the new mtimes so the next run doesn't have to rehash
+        write_meta(cache_folder, cache_key, meta["columns"])
+    return pd.DataFrame(columns, columns=meta["columns"], copy=False)
+
+def write_cache(cache_folder, cache_key, df):
+    os.makedirs(cache_folder, exist_ok=True)
+    # Remove the old meta file first so a partially written cache is never loaded
+    if os.path.exists(cache_folder + "meta.json"):
+        os.remove(cache_folder + "meta.json")
+    columns = list(df.columns)
+    for column in columns:
+        values = df[column].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(cache_folder + column + ".npy", values, allow_pickle=False)
+    write_meta(cache_folder, cache_key, columns)
+
+def write_meta(cache_folder, cache_key, columns):
+    meta_file = cache_folder + "meta.json"
+    with open(meta_file + ".tmp", "w") as f:
+        json.dump({"key" : cache_key, "columns" : columns}, f, indent=4)
+    os.replace(meta_file + ".tmp", meta_file)
 
 class Synthpop_Data:
 
-    def __init__(self):
+    def __init__(self, datafolder="synthpop-data/"):
         # Find the paths to all the synthpop provided data
-        datafolder = "synthpop-data/"
         person_file = datafolder + "person.csv"
         pop_df = pd.read_csv(person_file)
         kept_columns = ["ESR", "SCH"]
         self.synthpop_data = total_df = pop_df[kept_columns].reset_index(drop=True)
-
-    def sample_user(self):
         student_options = [2.0, 3.0]
         worker_options = [1.0, 2.0, 4.0, 5.0]
-        upper_bound = len(self.synthpop_data.index)
-        user_index = np.random.randint(upper_bound)
-        is_student = self.synthpop_data.at[user_index, "SCH"] in student_options
-        is_worker = self.synthpop_data.at[user_index, "ESR"] in worker_options
-        return (is_student, is_worker)
+        self.is_student = self.synthpop_data.SCH.isin(student_options).to_numpy()
+        self.is_worker = self.synthpop_data.ESR.isin(worker_options).to_numpy()
+
+    def __len__(self):
+        return len(self.synthpop_data.index)
+
+    def sample_users(self, count):
+        user_indices = np.random.randint(len(self), size=count)
+        return self.is_student[user_indices], self.is_worker[user_indices]
+
+    def get_users(self, start, end):
+        return self.is_student[start:end], self.is_worker[start:end]
+
+    def sample_user(self):
+        user_index = np.random.randint(len(self))
+        return (bool(self.is_student[user_index]), bool(self.is_worker[user_index]))
@@ -0,0 +1,201 @@
+import collections
+import json
+import math
+import sqlite3
+import threading
+import time
+from metrics import metrics
+
+# Cache in front of a get_locations_in_box style function. Requested boxes
+# are snapped outwards to a grid so that nearby queries share an entry, and
+# any cached box for the same searches that fully contains a request is
+# answered by filtering its elements locally. Entries are kept in an
+# in-memory LRU and, if a cache file is given, in SQLite across runs.
+
+def snap_box(min_lat, min_lon, max_lat, max_lon, grid_size):
+    def snap(value, rounding):
+        return round(rounding(round(value / grid_size, 9)) * grid_size, 9)
+    return (snap(min_lat, math.floor), snap(min_lon, math.floor),
+            snap(max_lat, math.ceil), snap(max_lon, math.ceil))
+
+def box_contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and outer[2] >= inner[2] and outer[3] >= inner[3])
+
+def get_searches_key(searches):
+    return json.dumps(sorted(set(tuple(search) for search in searches)))
+
+def filter_to_box(elements, min_lat, min_lon, max_lat, max_lon):
+    return [elem for elem in elements
+            if min_lat <= elem["lat"] <= max_lat and min_lon <= elem["lon"] <= max_lon]
+
+class LocationCache:
+
+    def __init__(self, get_locations, cache_file=None, grid_size=0.01, memory_size=1024,
+            ttl=None, max_entries=100000, get_locations_for_searches=None):
+        self.get_locations = get_locations
+        # Optional get_locations_for_searches(box_searches) style function
+        # that fetches several (box, searches) pairs at once and returns an
+        # exception in place of the elements of pairs it failed to get
+        self.get_locations_for_searches_function = get_locations_for_searches
+        self.grid_size = grid_size
+        self.memory_size = memory_size
+        # Seconds before an entry is refetched, None to keep them forever
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.cache_file = cache_file
+        self.db = None
+        self.open_db()
+
+    def open_db(self):
+        if self.cache_file is not None:
+            # Other processes may write to the same file, so wait for their locks
+            self.db = sqlite3.connect(self.cache_file, timeout=60, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS boxes (searches TEXT, min_lat REAL,"
+                    " min_lon REAL, max_lat REAL, max_lon REAL, created REAL, last_used REAL,"
+                    " elements TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS boxes_searches ON boxes (searches, min_lat)")
+            self.db.commit()
+
+    def reopen(self):
+        # SQLite connections can't be used across a fork
+        self.lock = threading.RLock()
+        self.open_db()
+
+    def get_locations_in_box(self, min_lat, min_lon, max_lat, max_lon, searches):
+        searches_key = get_searches_key(searches)
+        box = (min_lat, min_lon, max_lat, max_lon)
+        elements = self.get_cached(searches_key, box)
+        if elements is not None:
+            return elements
+        snapped = snap_box(*box, self.grid_size)
+        elements = self.get_locations(*snapped, searches)
+        self.add(searches_key, snapped, elements)
+        return filter_to_box(elements, *box)
+
+    def get_locations_for_searches(self, box_searches):
+        # Answers what it can from the cache and fetches all of the missed
+        # (box, searches) pairs together
+        if self.get_locations_for_searches_function is None:
+            return [self.get_locations_in_box(*box, searches) for box, searches in box_searches]
+        keys = [get_searches_key(searches) for _, searches in box_searches]
+        results = [self.get_cached(searches_key, tuple(box))
+                for searches_key, (box, _) in zip(keys, box_searches)]
+        missed = [k for k, elements in enumerate(results) if elements is None]
+        # Nearby misses for the same searches can snap to the same box
+        snapped = collections.OrderedDict()
+        for k in missed:
+            box, searches = box_searches[k]
+            snapped[(keys[k], snap_box(*box, self.grid_size))] = searches
+        if snapped:
+            fetched = self.get_locations_for_searches_function(
+                    [(box, searches) for (_, box), searches in snapped.items()])
+            for (searches_key, box), elements in zip(list(snapped), fetched):
+                snapped[(searches_key, box)] = elements
+                if not isinstance(elements, Exception):
+                    self.add(searches_key, box, elements)
+        for k in missed:
+            box = box_searches[k][0]
+            elements = snapped[(keys[k], snap_box(*box, self.grid_size))]
+            results[k] = elements if isinstance(elements, Exception) else filter_to_box(elements, *box)
+        return results
+
+    def get_cached(self, searches_key, box):
+        # The cached elements in box, None if no entry covers it
+        with self.lock:
+            elements = self.get_from_memory(searches_key, box)
+            if elements is not None:
+                metrics.count("location_cache", label="memory_hit")
+                return filter_to_box(elements, *box)
+            cached = self.get_from_disk(searches_key, box)
+            if cached is not None:
+                metrics.count("location_cache", label="disk_hit")
+                self.add_to_memory(searches_key, cached[0], cached[1])
+                return filter_to_box(cached[1], *box)
+            metrics.count("location_cache", label="miss")
+        return None
+
+    def add(self, searches_key, box, elements):
+        with self.lock:
+            self.add_to_memory(searches_key, box, elements)
+            self.add_to_disk(searches_key, box, elements)
+
+    def get_from_memory(self, searches_key, box):
+        snapped = snap_box(*box, self.grid_size)
+        entry_key = (searches_key, snapped)
+        if entry_key not in self.memory:
+            # Fall back to any larger box for the same searches
+            entry_key = None
+            for other_key in reversed(self.memory):
+                if other_key[0] == searches_key and box_contains(other_key[1], box):
+                    entry_key = other_key
+                    break
+            if entry_key is None:
+                return None
+        created, elements = self.memory[entry_key]
+        if self.ttl is not None and time.time() - created > self.ttl:
+            del self.memory[entry_key]
+            return None
+        self.memory.move_to_end(entry_key)
+        return elements
+
+    def add_to_memory(self, searches_key, box, elements, created=None):
+        self.memory[(searches_key, box)] = (time.time() if created is None else created, elements)
+        self.memory.move_to_end((searches_key, box))
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get_from_disk(self, searches_key, box):
+        if self.db is None:
+            return None
+        min_created = -math.inf if self.ttl is None else time.time() - self.ttl
+        # Smallest stored box for these searches that contains the request
+        row = self.db.execute("SELECT rowid, min_lat, min_lon, max_lat, max_lon, elements FROM boxes"
+                " WHERE searches = ? AND min_lat <= ? AND min_lon <= ? AND max_lat >= ?"
+                " AND max_lon >= ? AND created >= ?"
+                " ORDER BY (max_lat - min_lat) * (max_lon - min_lon) LIMIT 1",
+                (searches_key, box[0], box[1], box[2], box[3], min_created)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE boxes SET last_used = ? WHERE rowid = ?", (time.time(), row[0]))
+        self.db.commit()
+        return tuple(row[1:5]), json.loads(row[5])
+
+    def add_to_disk(self, searches_key, box, elements):
+        if self.db is None:
+            return
+        now = time.time()
+        self.db.execute("INSERT INTO boxes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (searches_key, *box, now, now, json.dumps(elements)))
+        self.evict(now)
+        self.db.commit()
+
+    def evict(self, now):
+        if self.ttl is not None:
+            self.db.execute("DELETE FROM boxes WHERE created < ?", (now - self.ttl,))
+        # Drop the least recently used entries past max_entries
+        self.db.execute("DELETE FROM boxes WHERE rowid IN (SELECT rowid FROM boxes"
+                " ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def get_counts(self):
+        # Memory hits, disk hits and misses from the metrics, which include
+        # the counts of worker processes
+        counters = metrics.summary()["counters"]
+        return tuple(counters.get("location_cache[{}]".format(label), 0)
+                for label in ("memory_hit", "disk_hit", "miss"))
+
+    def hit_rate(self):
+        memory_hits, disk_hits, misses = self.get_counts()
+        total = memory_hits + disk_hits + misses
+        return 0.0 if total == 0 else (memory_hits + disk_hits) / total
+
+    def report(self):
+        return "Location cache: {} memory hits, {} disk hits, {} misses, hit rate {:.1%}".format(
+                *self.get_counts(), self.hit_rate())
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -1,12 +1,104 @@
 import argparse
-import distribution
-import select_trips
-import decorate_tours
+import cProfile
+import tracemalloc
+import metrics
+
+def run(args):
+    # Runs the steps selected by args.mode. Modules are imported by the steps
+    # that use them, so --help stays fast and e.g. --mode 2 never loads pandas
+    # and --location_backend osm never loads requests.
+    import tour_io
+    checkpoint = None
+    if args.checkpoint_dir is not None:
+        import decoration_checkpoint
+        checkpoint = decoration_checkpoint.DecorationCheckpoint(args.checkpoint_dir,
+            args.checkpoint_every)
+    concurrency = args.concurrency
+    cache = None
+    store = None
+    if args.mode & 2:
+        import decorate_tours
+        decorate_tours.closest_candidates = args.closest_candidates
+        if args.location_backend == "osm":
+            import osm_index
+            decorate_tours.location_backend = osm_index.load_or_build_index(args.osm_file,
+                args.osm_index, decorate_tours.get_search_tags(), args.rebuild_osm_index)
+        else:
+            import overpass_client
+            client = overpass_client.OverpassClient(args.overpass_url or decorate_tours.overpass_url,
+                max_retries=args.overpass_retries, pool_size=max(concurrency, 1))
+            if concurrency > 1:
+                rate_limit = client.get_status().rate_limit
+                if rate_limit > 0:
+                    concurrency = min(concurrency, rate_limit)
+                # The worker processes share the server's slots
+                client.set_max_in_flight(max(1, concurrency // max(args.workers, 1)))
+            decorate_tours.overpass_client = client
+        if not args.no_location_cache:
+            import location_cache
+            get_locations_for_searches = None
+            if decorate_tours.location_backend is None:
+                get_locations = decorate_tours.get_overpass_locations_in_box
+                get_locations_for_searches = decorate_tours.get_overpass_locations_for_searches
+            else:
+                get_locations = decorate_tours.location_backend.get_locations_in_box
+            cache = location_cache.LocationCache(get_locations, args.location_cache,
+                args.cache_grid, ttl=None if args.cache_ttl is None else args.cache_ttl * 3600,
+                max_entries=args.cache_max_entries,
+                get_locations_for_searches=get_locations_for_searches)
+            decorate_tours.location_backend = cache
+        if args.decoration_store is not None:
+            import decoration_store
+            store = decoration_store.DecorationStore(args.decoration_store)
+            decorate_tours.decoration_store = store
+    nhts_info = None
+    synthpop_info = None
+    if args.mode & 1:
+        import distribution
+        nhts_info = distribution.NHTS_Data(use_cache=not args.no_cache,
+            rebuild_cache=args.rebuild_cache, use_weights=args.use_weights)
+        synthpop_info = distribution.Synthpop_Data()
+    if args.workers > 0:
+        import sharding
+        tours = None
+        if not args.mode & 1:
+            tours = tour_io.read_tours(args.tour_json)
+        write_tours = args.mode == 1 or (args.mode == 3 and (not args.stream or args.write_intermediate))
+        seed = sharding.run_sharded(args.workers, args.seed, args.shard_size, nhts_info,
+            synthpop_info, args.num_tours, args.tour_per_person, tours,
+            args.tour_json if write_tours else None,
+            args.output_file if args.mode & 2 else None, concurrency, args.coalesce_tours)
+        if args.seed is None:
+            print("Used seed {}".format(seed))
+    elif args.stream and args.mode == 3:
+        import select_trips
+        tours = select_trips.iter_tours(nhts_info, synthpop_info, args.num_tours,
+            args.batch_size, args.tour_per_person, args.seed, args.shard_size)
+        if args.write_intermediate:
+            tours = tour_io.write_tours_as_generated(tours, args.tour_json)
+        decorate_tours.decorate_tour_stream(tours, args.output_file, concurrency, args.seed,
+            checkpoint, args.resume, args.coalesce_tours)
+    else:
+        if args.mode & 1:
+            import select_trips
+            select_trips.generate_tours(nhts_info, synthpop_info, args.tour_json, args.num_tours,
+                args.batch_size, args.tour_per_person, args.seed, args.shard_size)
+        if args.mode & 2:
+            decorate_tours.decorate_tours(args.tour_json, args.output_file, concurrency,
+                args.seed, checkpoint, args.resume, args.coalesce_tours)
+    if cache is not None:
+        print(cache.report())
+        cache.close()
+    if store is not None:
+        print(store.report())
+        store.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--tour_json", type=str,
-        help="Name of the intermediate file for the abstract tour model",
+        help="Name of the intermediate file for the abstract tour model. Names" +
+        " ending in .jsonl hold one tour per line and names ending in .tours are" +
+        " a directory of memory mapped columns",
         default = "intermediates/intermediate.json")
     parser.add_argument("--mode", type=int,
         help="value to indicate which steps should run. 1 is just" +  
@@ -14,13 +106,128 @@ if __name__ == '__main__':
         " tour model to real locations and 3 is both.", default=3)
     parser.add_argument("--num_tours", type=int,
         help="Number of fake tours to generate", default=100)
+    parser.add_argument("--batch_size", type=int,
+        help="Generate tours in batches of this many tours at a time. With --seed" +
+        " tours are generated in blocks of --shard_size instead", default=None)
+    parser.add_argument("--tour_per_person", action="store_true",
+        help="Generate one tour for every synthpop person instead of --num_tours")
     parser.add_argument("--output_file", type=str,
         help="File to write the output of the decorated tour", 
         default="populations/population.xml")
+    parser.add_argument("--rebuild_cache", action="store_true",
+        help="Reprocess the nhts csvs even if a valid cache exists")
+    parser.add_argument("--no_cache", action="store_true",
+        help="Neither read nor write the preprocessed nhts cache")
+    parser.add_argument("--use_weights", action="store_true",
+        help="Sample nhts users according to their survey person weights")
+    parser.add_argument("--stream", action="store_true",
+        help="With --mode 3, decorate tours as they are generated instead of" +
+        " going through the intermediate file")
+    parser.add_argument("--write_intermediate", action="store_true",
+        help="With --stream, also write the tours to --tour_json, which must" +
+        " end in .jsonl or .tours")
+    parser.add_argument("--location_backend", type=str, choices=["overpass", "osm"],
+        help="Where to look up real locations: the Overpass server or a local" +
+        " index of an OSM extract", default="overpass")
+    parser.add_argument("--osm_file", type=str,
+        help="OSM extract (.osm, .pbf or .geojson) to build the local index from",
+        default=None)
+    parser.add_argument("--osm_index", type=str,
+        help="File the local location index is saved to and loaded from",
+        default="osm-data/poi_index.npz")
+    parser.add_argument("--rebuild_osm_index", action="store_true",
+        help="Rebuild the local location index from --osm_file even if it is saved")
+    parser.add_argument("--location_cache", type=str,
+        help="SQLite file to cache location queries in across runs. Queries are" +
+        " only cached in memory if not given", default=None)
+    parser.add_argument("--no_location_cache", action="store_true",
+        help="Send every location query to the location backend")
+    parser.add_argument("--cache_grid", type=float,
+        help="Grid size in degrees that cached query boxes are snapped to", default=0.01)
+    parser.add_argument("--cache_ttl", type=float,
+        help="Hours before a cached location query is refetched", default=None)
+    parser.add_argument("--cache_max_entries", type=int,
+        help="Most query results to keep in the location cache file", default=100000)
+    parser.add_argument("--decoration_store", type=str,
+        help="SQLite file that decorated tours are kept in, so re-runs only decorate" +
+        " tours whose plan, searches or seed changed. Delete it when the location" +
+        " data changes. Needs --seed", default=None)
+    parser.add_argument("--concurrency", type=int,
+        help="Number of tours to decorate at once. With the Overpass backend this" +
+        " is capped by the slots the server reports", default=1)
+    parser.add_argument("--coalesce_tours", type=int,
+        help="Decorate this many tours in lockstep and send their location queries" +
+        " together, one multi-box query per category", default=1)
+    parser.add_argument("--closest_candidates", type=int,
+        help="Pick each location at random from this many of the candidates whose" +
+        " distance is closest to the trip's", default=1)
+    parser.add_argument("--seed", type=int,
+        help="Seed for tour generation and decoration. Runs with the same seed give" +
+        " the same tours and output for any --concurrency or --workers", default=None)
+    parser.add_argument("--overpass_url", type=str,
+        help="Base url of the Overpass server, decorate_tours.overpass_url by default",
+        default=None)
+    parser.add_argument("--overpass_retries", type=int,
+        help="Times to retry a failed Overpass query before giving up on it", default=5)
+    parser.add_argument("--checkpoint_dir", type=str,
+        help="Directory to checkpoint decoration progress in", default=None)
+    parser.add_argument("--checkpoint_every", type=int,
+        help="Number of tours between decoration checkpoints", default=100)
+    parser.add_argument("--resume", action="store_true",
+        help="Continue decorating from the last checkpoint in --checkpoint_dir")
+    parser.add_argument("--workers", type=int,
+        help="Split the tours into shards and process them in this many worker" +
+        " processes. The output only depends on --seed and --shard_size", default=0)
+    parser.add_argument("--shard_size", type=int,
+        help="Number of consecutive tours in each shard with --workers, and in each" +
+        " separately seeded block of generated tours with --seed", default=1000)
+    parser.add_argument("--metrics_file", type=str,
+        help="File to write run metrics to, as csv if it ends in .csv and json otherwise",
+        default=None)
+    parser.add_argument("--progress", action="store_true",
+        help="Show a live progress line on stderr")
+    parser.add_argument("--profile", type=str, choices=["cprofile", "tracemalloc"],
+        help="Profile the run with cProfile or tracemalloc", default=None)
+    parser.add_argument("--profile_output", type=str,
+        help="File for the profile, profile.prof or tracemalloc.txt by default", default=None)
     args = parser.parse_args()
-    if args.mode & 1:
-        nhts_info = distribution.NHTS_Data()
-        synthpop_info = distribution.Synthpop_Data()
-        select_trips.generate_tours(nhts_info, synthpop_info, args.tour_json, args.num_tours)
-    if args.mode & 2:
-        decorate_tours.decorate_tours(args.tour_json, args.output_file)
+    if args.write_intermediate:
+        import tour_io
+        if not tour_io.can_append(args.tour_json):
+            parser.error("--write_intermediate needs a --tour_json ending in .jsonl or .tours")
+    if args.resume and args.checkpoint_dir is None:
+        parser.error("--resume needs --checkpoint_dir")
+    if args.resume and args.mode != 2:
+        # Generating tours again would replace the ones the checkpoint was made from
+        parser.error("--resume can only be used with --mode 2")
+    if args.closest_candidates < 1:
+        parser.error("--closest_candidates must be at least 1")
+    if args.coalesce_tours < 1:
+        parser.error("--coalesce_tours must be at least 1")
+    if args.decoration_store is not None and args.seed is None:
+        # The seed is part of every stored key, so a random one would never be reused
+        parser.error("--decoration_store needs --seed")
+    if args.workers > 0 and args.checkpoint_dir is not None:
+        parser.error("--checkpoint_dir can't be used with --workers")
+
+    metrics.metrics.reset()
+    if args.progress:
+        metrics.metrics.enable_progress()
+    if args.profile == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.runcall(run, args)
+        profiler.dump_stats(args.profile_output or "profile.prof")
+    elif args.profile == "tracemalloc":
+        tracemalloc.start()
+        run(args)
+        statistics = tracemalloc.take_snapshot().statistics("lineno")
+        with open(args.profile_output or "tracemalloc.txt", "w") as f:
+            for statistic in statistics[:50]:
+                print(statistic, file=f)
+        tracemalloc.stop()
+    else:
+        run(args)
+    if args.metrics_file is not None:
+        metrics.metrics.write(args.metrics_file)
+    elif args.progress:
+        metrics.metrics.print_progress(end="\n")
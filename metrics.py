@@ -0,0 +1,144 @@
+import collections
+import contextlib
+import csv
+import json
+import resource
+import sys
+import threading
+import time
+
+# Process wide run metrics: wall time per stage, counters with an optional
+# label (e.g. radius expansions per destination category), value summaries
+# (e.g. Overpass request latency), tours per second and peak memory. Stage
+# times are summed over threads, so with concurrent decoration they can add
+# up to more than the wall time of the run. Peak memory is that of the
+# largest process, counting the worker processes whose metrics were merged.
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.progress_stream = None
+        self.progress_interval = 1.0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.stage_seconds = collections.defaultdict(float)
+            self.stage_calls = collections.defaultdict(int)
+            self.counters = collections.defaultdict(int)
+            # name -> [count, total, min, max]
+            self.values = dict()
+            self.tours = 0
+            self.worker_peak_rss = 0
+            self.last_progress = 0.0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stage_seconds[name] += seconds
+                self.stage_calls[name] += 1
+
+    def count(self, name, amount=1, label=None):
+        key = name if label is None else "{}[{}]".format(name, label)
+        with self.lock:
+            self.counters[key] += amount
+
+    def observe(self, name, value):
+        with self.lock:
+            summary = self.values.get(name)
+            if summary is None:
+                self.values[name] = [1, value, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = min(summary[2], value)
+                summary[3] = max(summary[3], value)
+
+    def record_tour(self):
+        with self.lock:
+            self.tours += 1
+        if self.progress_stream is not None:
+            now = time.time()
+            if now - self.last_progress >= self.progress_interval:
+                self.last_progress = now
+                self.print_progress()
+
+    def enable_progress(self, stream=sys.stderr, interval=1.0):
+        self.progress_stream = stream
+        self.progress_interval = interval
+
+    def print_progress(self, end=""):
+        elapsed = time.time() - self.start_time
+        rate = self.tours / elapsed if elapsed > 0 else 0.0
+        print("\r{} tours, {:.1f} tours/s, {} requests, peak rss {:.0f} MB".format(self.tours, rate,
+                self.counters.get("overpass_requests", 0), self.get_peak_rss() / 2 ** 20),
+                end=end, file=self.progress_stream, flush=True)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            return {"elapsed_seconds" : elapsed, "tours" : self.tours,
+                    "tours_per_second" : self.tours / elapsed if elapsed > 0 else 0.0,
+                    "peak_rss_bytes" : self.get_peak_rss(),
+                    "stages" : {name : {"seconds" : seconds, "calls" : self.stage_calls[name]}
+                        for name, seconds in self.stage_seconds.items()},
+                    "counters" : dict(self.counters),
+                    "values" : {name : {"count" : count, "mean" : total / count, "min" : low,
+                        "max" : high, "total" : total}
+                        for name, (count, total, low, high) in self.values.items()}}
+
+    def merge(self, summary):
+        # Adds the counts from another process's summary, e.g. a worker's
+        with self.lock:
+            self.tours += summary["tours"]
+            self.worker_peak_rss = max(self.worker_peak_rss, summary["peak_rss_bytes"])
+            for name, stage in summary["stages"].items():
+                self.stage_seconds[name] += stage["seconds"]
+                self.stage_calls[name] += stage["calls"]
+            for name, amount in summary["counters"].items():
+                self.counters[name] += amount
+            for name, value in summary["values"].items():
+                mine = self.values.get(name)
+                if mine is None:
+                    self.values[name] = [value["count"], value["total"], value["min"], value["max"]]
+                else:
+                    self.values[name] = [mine[0] + value["count"], mine[1] + value["total"],
+                            min(mine[2], value["min"]), max(mine[3], value["max"])]
+
+    def get_peak_rss(self):
+        return max(get_peak_rss(), self.worker_peak_rss)
+
+    def write(self, metrics_file):
+        # json, or a flat metric,value csv if the file ends in .csv
+        summary = self.summary()
+        if self.progress_stream is not None:
+            self.print_progress(end="\n")
+        if not metrics_file.endswith(".csv"):
+            with open(metrics_file, "w") as f:
+                json.dump(summary, f, indent=4)
+            return
+        with open(metrics_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["metric", "value"])
+            for name in ["elapsed_seconds", "tours", "tours_per_second", "peak_rss_bytes"]:
+                writer.writerow([name, summary[name]])
+            for group in ["stages", "values"]:
+                for name, fields in summary[group].items():
+                    for field, value in fields.items():
+                        writer.writerow(["{}.{}.{}".format(group, name, field), value])
+            for name, value in summary["counters"].items():
+                writer.writerow(["counters.{}".format(name), value])
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+metrics = Metrics()
@@ -0,0 +1,175 @@
+import numpy as np
+import json
+import os
+
+# Local replacement for the Overpass node queries in decorate_tours. Nodes
+# from an OSM extract are grouped by the (key, value) tags we search for and
+# each group is stored in a uniform lat/lon grid, sorted by cell, so a
+# bounding box query only looks at the cells it overlaps.
+
+cell_size = 0.01
+num_cols = int(np.ceil(360.0 / cell_size)) + 1
+# Past this many grid rows it is cheaper to scan a whole category
+max_scanned_rows = 256
+
+def get_cells(lat, lon):
+    row = np.floor((np.asarray(lat) + 90.0) / cell_size).astype(np.int64)
+    col = np.floor((np.asarray(lon) + 180.0) / cell_size).astype(np.int64)
+    return row, col
+
+class OSMIndex:
+
+    def __init__(self, nodes_by_tag, tags=None):
+        # nodes_by_tag maps (key, value) to (ids, lats, lons) sequences. tags
+        # are all of the tags that were indexed, including any without nodes.
+        self.tags = set(tuple(tag) for tag in (tags if tags is not None else nodes_by_tag))
+        self.categories = dict()
+        for tag, (ids, lats, lons) in nodes_by_tag.items():
+            ids = np.asarray(ids, dtype=np.int64)
+            lats = np.asarray(lats, dtype=np.float64)
+            lons = np.asarray(lons, dtype=np.float64)
+            row, col = get_cells(lats, lons)
+            keys = row * num_cols + col
+            order = np.argsort(keys, kind="mergesort")
+            self.categories[tuple(tag)] = (keys[order], ids[order], lats[order], lons[order])
+
+    def get_locations_in_box(self, min_lat, min_lon, max_lat, max_lon, searches):
+        # Same results as the Overpass node query: every node matching any of
+        # the searches, once, with the matching tags
+        results = dict()
+        for key, value in searches:
+            category = self.categories.get((key, value))
+            if category is None:
+                continue
+            ids, lats, lons = self.query_category(category, min_lat, min_lon, max_lat, max_lon)
+            for node_id, lat, lon in zip(ids.tolist(), lats.tolist(), lons.tolist()):
+                if node_id not in results:
+                    results[node_id] = {"type" : "node", "id" : node_id, "lat" : lat,
+                            "lon" : lon, "tags" : dict()}
+                results[node_id]["tags"][key] = value
+        return list(results.values())
+
+    def query_category(self, category, min_lat, min_lon, max_lat, max_lon):
+        keys, ids, lats, lons = category
+        min_row, min_col = get_cells(max(min_lat, -90.0), max(min_lon, -180.0))
+        max_row, max_col = get_cells(min(max_lat, 90.0), min(max_lon, 180.0))
+        if max_row - min_row >= max_scanned_rows:
+            candidates = np.arange(keys.shape[0])
+        else:
+            rows = np.arange(min_row, max_row + 1) * num_cols
+            starts = np.searchsorted(keys, rows + min_col, side="left")
+            ends = np.searchsorted(keys, rows + max_col, side="right")
+            candidates = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]
+                    + [np.empty(0, dtype=np.int64)])
+        in_box = ((lats[candidates] >= min_lat) & (lats[candidates] <= max_lat)
+                & (lons[candidates] >= min_lon) & (lons[candidates] <= max_lon))
+        candidates = candidates[in_box]
+        return ids[candidates], lats[candidates], lons[candidates]
+
+    def save(self, index_file):
+        arrays = dict()
+        tags = []
+        for i, (tag, (keys, ids, lats, lons)) in enumerate(self.categories.items()):
+            tags.append(list(tag))
+            arrays["ids_{}".format(i)] = ids
+            arrays["lats_{}".format(i)] = lats
+            arrays["lons_{}".format(i)] = lons
+        arrays["tags"] = np.array(json.dumps(tags))
+        arrays["indexed_tags"] = np.array(json.dumps(sorted(list(tag) for tag in self.tags)))
+        np.savez(index_file, **arrays)
+
+    @staticmethod
+    def load(index_file):
+        with np.load(index_file) as arrays:
+            tags = json.loads(str(arrays["tags"]))
+            nodes_by_tag = dict()
+            for i, tag in enumerate(tags):
+                nodes_by_tag[tuple(tag)] = (arrays["ids_{}".format(i)],
+                        arrays["lats_{}".format(i)], arrays["lons_{}".format(i)])
+            indexed_tags = None
+            if "indexed_tags" in arrays:
+                indexed_tags = json.loads(str(arrays["indexed_tags"]))
+        return OSMIndex(nodes_by_tag, indexed_tags)
+
+
+def load_or_build_index(osm_file, index_file, tags, rebuild=False):
+    # Reuse a saved index unless asked to rebuild, the extract is newer or it
+    # is missing some of tags, e.g. after a search was added
+    if (index_file is not None and os.path.exists(index_file) and not rebuild
+            and (osm_file is None or os.path.getmtime(index_file) >= os.path.getmtime(osm_file))):
+        index = OSMIndex.load(index_file)
+        missing = set(tuple(tag) for tag in tags) - index.tags
+        if not missing:
+            return index
+        if osm_file is None:
+            raise ValueError("{} doesn't index {}, an OSM extract is needed to rebuild it".format(
+                    index_file, ", ".join("{}={}".format(*tag) for tag in sorted(missing))))
+    if osm_file is None:
+        raise ValueError("An OSM extract is needed to build the location index")
+    index = build_index(osm_file, tags)
+    if index_file is not None:
+        index.save(index_file)
+    return index
+
+def build_index(osm_file, tags):
+    tags = set(tuple(tag) for tag in tags)
+    if osm_file.endswith(".pbf"):
+        nodes = read_pbf_nodes(osm_file, tags)
+    elif osm_file.endswith(".geojson") or osm_file.endswith(".json"):
+        nodes = read_geojson_nodes(osm_file, tags)
+    else:
+        nodes = read_xml_nodes(osm_file, tags)
+    nodes_by_tag = dict()
+    for node_id, lat, lon, node_tags in nodes:
+        for tag in node_tags.items():
+            if tag in tags:
+                ids, lats, lons = nodes_by_tag.setdefault(tag, ([], [], []))
+                ids.append(node_id)
+                lats.append(lat)
+                lons.append(lon)
+    return OSMIndex(nodes_by_tag, tags)
+
+def read_xml_nodes(osm_file, tags):
+    from lxml import etree
+    keys = set(tag[0] for tag in tags)
+    for _, elem in etree.iterparse(osm_file, events=("end",), tag=("node", "way", "relation")):
+        if elem.tag == "node":
+            node_tags = dict()
+            for tag_elem in elem.iterchildren("tag"):
+                if tag_elem.get("k") in keys:
+                    node_tags[tag_elem.get("k")] = tag_elem.get("v")
+            if node_tags:
+                yield int(elem.get("id")), float(elem.get("lat")), float(elem.get("lon")), node_tags
+        # Free every parsed element as we go, including the ways and
+        # relations we skip, extracts can be many GB
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+def read_pbf_nodes(osm_file, tags):
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError("Reading .pbf extracts needs the osmium package")
+    keys = set(tag[0] for tag in tags)
+    for node in osmium.FileProcessor(osm_file, osmium.osm.NODE):
+        node_tags = {tag.k : tag.v for tag in node.tags if tag.k in keys}
+        if node_tags and node.location.valid():
+            yield node.id, node.location.lat, node.location.lon, node_tags
+
+def read_geojson_nodes(osm_file, tags):
+    # Handles point features as exported by overpass turbo or osmtogeojson,
+    # where the osm tags are either the properties or properties["tags"]
+    with open(osm_file, "r") as f:
+        features = json.load(f)["features"]
+    for i, feature in enumerate(features):
+        geometry = feature.get("geometry")
+        if geometry is None or geometry["type"] != "Point":
+            continue
+        properties = feature.get("properties") or dict()
+        node_tags = properties.get("tags", properties)
+        feature_id = str(feature.get("id", properties.get("@id", ""))).split("/")[-1]
+        # Features without an osm id get negative ids so they can't collide
+        node_id = int(feature_id) if feature_id.isdigit() else -(i + 1)
+        lon, lat = geometry["coordinates"][:2]
+        yield node_id, float(lat), float(lon), node_tags
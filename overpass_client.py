@@ -0,0 +1,173 @@
+import random
+import re
+import threading
+import time
+from metrics import metrics
+
+# Client for the Overpass API that reuses one pooled keep-alive session and
+# retries failed queries with jittered exponential backoff. An empty list
+# from query means the server found nothing; anything the server failed to
+# answer raises an OverpassError instead. requests is only imported once a
+# client is used, so runs with a local location index don't load it.
+
+class OverpassError(Exception):
+    pass
+
+class OverpassQueryError(OverpassError):
+    # The server rejected the query itself, retrying won't help
+    pass
+
+class OverpassServerError(OverpassError):
+    # The server kept failing or timing out after all of the retries
+    pass
+
+class OverpassStatus:
+
+    def __init__(self, rate_limit=0, slots_available=0, slot_waits=None):
+        # rate_limit is 0 when the server doesn't limit us
+        self.rate_limit = rate_limit
+        self.slots_available = slots_available
+        # Seconds until each busy slot is free again
+        self.slot_waits = slot_waits if slot_waits is not None else []
+
+    def get_wait_time(self):
+        # Seconds to wait before a slot is free, None if the status doesn't say
+        if self.rate_limit == 0 or self.slots_available > 0:
+            return 0
+        if self.slot_waits:
+            return min(self.slot_waits)
+        return None
+
+def parse_status(status_text):
+    # api/status looks like
+    #   Connected as: 1234567
+    #   Current time: 2020-01-01T00:00:00Z
+    #   Rate limit: 2
+    #   1 slots available now.
+    #   Slot available after: 2020-01-01T00:00:05Z, in 5 seconds.
+    #   Currently running queries (pid, space limit, time limit, start time):
+    status = OverpassStatus()
+    for line in status_text.splitlines():
+        line = line.strip()
+        match = re.match(r"Rate limit: (\d+)", line)
+        if match:
+            status.rate_limit = int(match.group(1))
+            continue
+        match = re.match(r"(\d+) slots? available now", line)
+        if match:
+            status.slots_available = int(match.group(1))
+            continue
+        match = re.match(r"Slot available after: .*, in (-?\d+) seconds?", line)
+        if match:
+            status.slot_waits.append(max(0, int(match.group(1))))
+    return status
+
+class OverpassClient:
+
+    def __init__(self, url, max_retries=5, backoff_base=1.0, backoff_max=60.0,
+            timeout=(10.0, 120.0), pool_size=16, max_in_flight=None):
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # (connect, read) timeouts in seconds
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.reopen()
+        self.in_flight = None
+        self.set_max_in_flight(max_in_flight)
+        # Jitter has its own generator so it never touches the numpy state
+        # that decoration results depend on
+        self.jitter = random.Random()
+        self.sleep = time.sleep
+
+    def reopen(self):
+        # Starts a new session, e.g. in a forked process
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Encoding" : "gzip, deflate"})
+
+    def set_max_in_flight(self, max_in_flight):
+        # Most queries to send at once, None for no limit
+        self.in_flight = None if max_in_flight is None else threading.BoundedSemaphore(max_in_flight)
+
+    def get_status(self):
+        response = self.session.get(self.url + "api/status", timeout=self.timeout)
+        response.raise_for_status()
+        return parse_status(response.text)
+
+    def query(self, overpass_query):
+        if self.in_flight is None:
+            return self.send_query(overpass_query)
+        with self.in_flight:
+            return self.send_query(overpass_query)
+
+    def send_query(self, overpass_query):
+        import requests
+        failure = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                metrics.count("overpass_retries")
+            wait_time = None
+            metrics.count("overpass_requests")
+            start = time.perf_counter()
+            try:
+                response = self.session.post(self.url + "api/interpreter", data=overpass_query,
+                        timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.count("overpass_connection_errors")
+                failure = "{}: {}".format(type(e).__name__, e)
+            else:
+                metrics.observe("overpass_latency_seconds", time.perf_counter() - start)
+                # After any gzip decoding, requests doesn't reliably tell
+                # how many bytes came over the wire
+                metrics.count("overpass_decoded_bytes", len(response.content))
+                metrics.count("overpass_responses", label=response.status_code)
+                if response.status_code == 200:
+                    try:
+                        result = response.json()
+                    except ValueError:
+                        failure = "Invalid json in the response"
+                    else:
+                        # Timeouts and out of memory errors still return 200
+                        # with whatever was found so far, so they can't be
+                        # trusted as a complete answer
+                        remark = result.get("remark", "")
+                        if "error" not in remark:
+                            return result["elements"]
+                        failure = remark
+                elif response.status_code == 400:
+                    raise OverpassQueryError(response.text)
+                elif response.status_code == 429:
+                    failure = "Rate limited"
+                    wait_time = self.get_slot_wait_time()
+                else:
+                    failure = "HTTP {}".format(response.status_code)
+            if attempt < self.max_retries:
+                self.sleep(self.get_backoff(attempt) if wait_time is None else wait_time)
+        metrics.count("overpass_failures")
+        raise OverpassServerError("Query failed after {} attempts: {}".format(
+                self.max_retries + 1, failure))
+
+    def get_slot_wait_time(self):
+        # Wait just long enough for the next slot, with a little slack since
+        # the server rounds to whole seconds
+        import requests
+        try:
+            wait_time = self.get_status().get_wait_time()
+        except requests.RequestException:
+            return None
+        if wait_time is None:
+            return None
+        return wait_time + self.jitter.uniform(0.0, 1.0)
+
+    def get_backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return self.jitter.uniform(delay / 2.0, delay)
+
+    def close(self):
+        self.session.close()
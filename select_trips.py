@@ -1,4 +1,6 @@
-import json
+import numpy as np
+import tour_io
+from metrics import metrics
 
 mode_map = {-9 : "Car", -8 : "Car", -7 : "Car", 1 : "Walk", 2 : "Bicycle", 
         3 : "Car", 4 : "Car", 5 : "Car", 6 : "Car", 7 : "Car", 8 : "Car",
@@ -6,22 +8,159 @@ mode_map = {-9 : "Car", -8 : "Car", -7 : "Car", 1 : "Walk", 2 : "Bicycle",
         13 : "Transit", 14 : "Transit", 15 : "Transit", 16 : "Transit",
         17 : "Car", 18 : "Car", 97 : "Car"}
 
-def generate_tours(nhts_info, synthpop_info, tour_json, num_tours):
+def generate_tours(nhts_info, synthpop_info, tour_json, num_tours, batch_size=None,
+        tour_per_person=False, seed=None, block_size=1000):
+    tours = iter_tours(nhts_info, synthpop_info, num_tours, batch_size, tour_per_person, seed,
+        block_size)
+    tour_io.write_tours(tours, tour_json)
+
+
+def iter_tours(nhts_info, synthpop_info, num_tours, batch_size=None, tour_per_person=False,
+        seed=None, block_size=1000):
+    # Yields tours one at a time so they can be consumed while the rest are
+    # still being generated. With a seed the tours are generated in blocks of
+    # block_size that are each seeded like a shard of sharding.run_sharded,
+    # so the same seed gives the same tours with or without workers and
+    # changing num_tours keeps the earlier blocks.
+    if seed is not None:
+        batch_size = block_size
+    if batch_size is None and not tour_per_person:
+        for i in range(num_tours):
+            yield {"Tour {}".format(i): create_tour(nhts_info, synthpop_info)}
+    else:
+        for batch in generate_tour_batches(nhts_info, synthpop_info, num_tours,
+                batch_size, tour_per_person, seed):
+            yield from batch
+
+
+def generate_tour_batches(nhts_info, synthpop_info, num_tours, batch_size=None,
+        tour_per_person=False, seed=None):
+    # Yields lists of tours, batch_size tours at a time. With tour_per_person
+    # every synthpop person gets exactly one tour in order and num_tours is
+    # ignored.
+    if tour_per_person:
+        num_tours = len(synthpop_info)
+    if batch_size is None:
+        batch_size = 10000
+    for block, start in enumerate(range(0, num_tours, batch_size)):
+        end = min(start + batch_size, num_tours)
+        yield generate_block(nhts_info, synthpop_info, block, start, end, tour_per_person, seed,
+            batch_size)
+
+
+def get_block_rng_state(seed, block):
+    # Tour decoration uses spawn keys (tour index,), so blocks use
+    # (block, 0) to get independent streams
+    seed_sequence = np.random.SeedSequence(seed, spawn_key=(block, 0))
+    return np.random.RandomState(np.random.MT19937(seed_sequence)).get_state()
+
+
+def generate_block(nhts_info, synthpop_info, block, start, end, tour_per_person=False,
+        seed=None, block_size=None):
+    # Tours start to end. Sampling uses the global numpy state, which is
+    # seeded for this block if a seed is given. A seeded block always samples
+    # block_size users and keeps the first ones, so a shorter last block
+    # starts with the same tours as the full one.
+    if seed is not None:
+        np.random.set_state(get_block_rng_state(seed, block))
+    if tour_per_person:
+        is_student, is_worker = synthpop_info.get_users(start, end)
+    else:
+        count = end - start
+        if seed is not None and block_size is not None:
+            count = max(count, block_size)
+        is_student, is_worker = synthpop_info.sample_users(count)
+    user_indices = nhts_info.sample_user_indices(np.stack((is_student, is_worker), axis=1))
+    is_student = is_student[:end - start]
+    is_worker = is_worker[:end - start]
+    user_indices = user_indices[:end - start]
+    return create_tours(nhts_info, user_indices, is_student, is_worker, start)
+
+
+def create_tours(nhts_info, user_indices, is_student, is_worker, first_tour=0):
+    # Column-wise version of create_tour for many sampled users at once
+    with metrics.stage("sample"):
+        tours = build_tours(nhts_info, user_indices, is_student, is_worker, first_tour)
+    metrics.count("tours_generated", len(tours))
+    return tours
+
+
+def build_tours(nhts_info, user_indices, is_student, is_worker, first_tour):
+    rows, tour_offsets = nhts_info.get_users_rows(user_indices)
+    trips = nhts_info.nhts_data.iloc[rows]
+    distances = get_distances(trips["TRPMILES"].to_numpy()).tolist()
+    modes = map_modes(trips["TRPTRANS"].to_numpy()).tolist()
+    dests = trips["WHYTO"].to_numpy(dtype=np.int64).tolist()
+    start_times = format_times(trips["STRTTIME"].to_numpy()).tolist()
+    end_times = format_times(trips["ENDTIME"].to_numpy()).tolist()
+
     tours = []
-    for i in range(num_tours):
-        tours.append({"Tour {}".format(i): create_tour(nhts_info, synthpop_info)})
-    with open(tour_json, "w") as f:
-        f.write(json.dumps(tours, indent=4))
-        f.flush()
+    for tour_index in range(len(user_indices)):
+        steps = []
+        for i in range(tour_offsets[tour_index], tour_offsets[tour_index + 1]):
+            distance = distances[i]
+            mode = modes[i]
+            # If distance is too large break a trip down into 2
+            # 1 that doesn't do a query and one that does
+            # Then omit the none query from the output
+            # to avoid complex calculations
+            if distance > 50.0:
+                steps.append({'dist' : distance, 'mode' : mode, 'dest_encoding' : 97,
+                    'temp' : True})
+                distance = 0.5
+            steps.append({'dist' : distance, 'dest_encoding' : dests[i], 'mode' : mode,
+                'start time' : start_times[i], 'end time' : end_times[i], 'temp' : False})
+        tour_info = {'plan' : steps, 'student' : bool(is_student[tour_index]),
+                'employed' : bool(is_worker[tour_index])}
+        tours.append({"Tour {}".format(first_tour + tour_index): tour_info})
+    return tours
+
+
+def map_modes(trptrans):
+    # Vectorized lookup of mode_map
+    codes = np.array(sorted(mode_map.keys()))
+    names = np.array([mode_map[code] for code in codes], dtype=object)
+    positions = np.searchsorted(codes, trptrans)
+    positions = np.minimum(positions, len(codes) - 1)
+    if not np.all(codes[positions] == trptrans):
+        missing = np.unique(trptrans[codes[positions] != trptrans])
+        raise KeyError(missing[0])
+    return names[positions]
+
+
+def get_distances(miles):
+    # Miles are stored as float32. Converting through their shortest decimal
+    # form writes e.g. 2.35 rather than 2.3499999046325684 to the tours.
+    if miles.dtype == np.float32:
+        return miles.astype(str).astype(np.float64)
+    return miles.astype(np.float64)
+
+
+def get_minutes(times):
+    # HHMM integers as minutes after midnight. Midpoints of round trips can
+    # have more than 59 minutes, which carry over into the hour.
+    return (times // 100) * 60 + times % 100
+
+
+def format_times(times):
+    # Vectorized version of formatting an HHMM integer as "H:MM"
+    return tour_io.format_times(get_minutes(times))
 
 
 def create_tour(nhts_info, synthpop_info):
+    with metrics.stage("sample"):
+        tour_info = build_tour(nhts_info, synthpop_info)
+    metrics.count("tours_generated")
+    return tour_info
+
+
+def build_tour(nhts_info, synthpop_info):
     tour_info = dict()
     steps = []
     is_student, is_worker = synthpop_info.sample_user()
     tour = nhts_info.sample_tour(is_student, is_worker)
     for i in range(len(tour.index)):
-        distance = float(tour.at[i, "TRPMILES"])
+        distance = float(get_distances(np.array([tour.at[i, "TRPMILES"]]))[0])
         mode = mode_map[tour.at[i, "TRPTRANS"]]
         # If distance is too large break a trip down into 2
         # 1 that doesn't do a query and one that does
@@ -40,14 +179,11 @@ def create_tour(nhts_info, synthpop_info):
         trip_dict['dist'] = distance
         trip_dict['dest_encoding'] = int(tour.at[i, "WHYTO"])
         trip_dict['mode'] = mode
-        time_info = str(tour.at[i, "STRTTIME"])
-        trip_dict['start time'] = "{}:{}".format(time_info[:-2], time_info[-2:])
-        time_info = str(tour.at[i, "ENDTIME"])
-        trip_dict['end time'] = "{}:{}".format(time_info[:-2], time_info[-2:])
+        trip_dict['start time'] = tour_io.format_time(get_minutes(tour.at[i, "STRTTIME"]))
+        trip_dict['end time'] = tour_io.format_time(get_minutes(tour.at[i, "ENDTIME"]))
         trip_dict['temp'] = False
         steps.append(trip_dict)
     tour_info['plan'] = steps
     tour_info['student'] = is_student
     tour_info['employed'] = is_worker
     return tour_info
-
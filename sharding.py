@@ -0,0 +1,159 @@
+import contextlib
+import json
+import multiprocessing
+import numpy as np
+import select_trips
+import tour_io
+from metrics import metrics
+
+# Splits a run into fixed size shards of consecutive tours and processes
+# them in a pool of worker processes. Shards are seeded from the master seed
+# and their shard number, and tours are decorated with random states derived
+# from their own index, so the output doesn't depend on the number of
+# workers. Shared inputs are set in module globals before the pool forks so
+# the workers read them copy-on-write instead of loading them again.
+
+nhts_info = None
+synthpop_info = None
+home_options = None
+# Memory mapped tour_io.TourColumns that workers read their shards from
+tour_source = None
+shard_settings = dict()
+in_worker = False
+
+def get_shards(num_tours, shard_size):
+    return [(shard, start, min(start + shard_size, num_tours))
+            for shard, start in enumerate(range(0, num_tours, shard_size))]
+
+def generate_shard(shard, start, end):
+    # Tour generation samples from the global numpy state, which is private
+    # to the worker process. Shards are seeded like the blocks of
+    # select_trips.iter_tours, so the tours don't depend on the workers.
+    return select_trips.generate_block(nhts_info, synthpop_info, shard, start, end,
+            shard_settings["tour_per_person"], shard_settings["seed"],
+            shard_settings["shard_size"])
+
+def decorate_shard(tours, start):
+    import decorate_tours
+    return decorate_tours.decorate_shard(tours, home_options, shard_settings["concurrency"],
+            shard_settings["seed"], start, shard_settings["coalesce"])
+
+def run_shard(job):
+    shard, start, end, tours = job
+    if tours is None and tour_source is not None:
+        tours = tour_source.read(start, end)
+    elif tours is None:
+        tours = generate_shard(shard, start, end)
+    fragment, failed = None, None
+    if shard_settings["decorate"]:
+        fragment, failed = decorate_shard(tours, start)
+        if not shard_settings["keep_tours"]:
+            tours = None
+    # Hand this shard's metrics to the parent process to add up
+    shard_metrics = None
+    if in_worker:
+        shard_metrics = metrics.summary()
+        metrics.reset()
+    return tours, fragment, failed, shard_metrics
+
+def init_worker():
+    global in_worker
+    in_worker = True
+    metrics.reset()
+    if not shard_settings["decorate"]:
+        return
+    # decorate_tours pulls in lxml, so it is only imported when decorating
+    import decorate_tours
+    # Connections can't be shared with the parent process after a fork
+    if decorate_tours.overpass_client is not None:
+        decorate_tours.overpass_client.reopen()
+    if hasattr(decorate_tours.location_backend, "reopen"):
+        decorate_tours.location_backend.reopen()
+    if decorate_tours.decoration_store is not None:
+        decorate_tours.decoration_store.reopen()
+    decorate_tours.logging_file = open("logs.txt", "a", buffering=1)
+
+def get_tour_shards(tours, shard_size):
+    # Groups already generated tours into shards
+    shard_tours = []
+    shard = 0
+    for tour in tours:
+        shard_tours.append(tour)
+        if len(shard_tours) == shard_size:
+            yield shard, shard * shard_size, (shard + 1) * shard_size, shard_tours
+            shard_tours = []
+            shard += 1
+    if shard_tours:
+        yield shard, shard * shard_size, shard * shard_size + len(shard_tours), shard_tours
+
+def run_sharded(workers, seed, shard_size, nhts=None, synthpop=None, num_tours=0,
+        tour_per_person=False, tours=None, tour_json=None, output_file=None, concurrency=1,
+        coalesce=1):
+    # Generates tours with nhts and synthpop, or decorates the given tours,
+    # or both, writing the tours to tour_json and the population to
+    # output_file if they are given. Returns the master seed.
+    global nhts_info, synthpop_info, home_options, tour_source
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    nhts_info = nhts
+    synthpop_info = synthpop
+    tour_source = None
+    decorate = output_file is not None
+    shard_settings.update({"seed" : seed, "shard_size" : shard_size,
+            "tour_per_person" : tour_per_person, "concurrency" : concurrency,
+            "coalesce" : coalesce, "decorate" : decorate, "keep_tours" : tour_json is not None})
+    if tours is None:
+        if tour_per_person:
+            num_tours = len(synthpop)
+        jobs = ((shard, start, end, None) for shard, start, end in get_shards(num_tours, shard_size))
+    elif isinstance(tours, tour_io.TourColumns):
+        # Workers read their own range instead of being sent the tours
+        tour_source = tours
+        jobs = ((shard, start, end, None) for shard, start, end in get_shards(len(tours), shard_size))
+    else:
+        jobs = get_tour_shards(tours, shard_size)
+    if decorate:
+        import decorate_tours
+        home_options = decorate_tours.get_home_locations()
+        if decorate_tours.decoration_store is not None:
+            decorate_tours.decoration_store.set_home_options(home_options)
+        open("logs.txt", "w").close()
+
+    if workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(workers, initializer=init_worker)
+        results = pool.imap(run_shard, jobs)
+    else:
+        pool = None
+        if decorate:
+            decorate_tours.logging_file = open("logs.txt", "a", buffering=1)
+        results = map(run_shard, jobs)
+
+    with contextlib.ExitStack() as stack:
+        if pool is not None:
+            stack.callback(pool.join)
+            stack.callback(pool.close)
+        population = None
+        if decorate:
+            population = stack.enter_context(decorate_tours.open_population_fragments(output_file))
+        failed = []
+        def get_tours():
+            # Results arrive in shard order, so they can be written as they come
+            for shard_tours, fragment, shard_failed, shard_metrics in results:
+                if shard_metrics is not None:
+                    metrics.merge(shard_metrics)
+                    if metrics.progress_stream is not None:
+                        metrics.print_progress()
+                if decorate:
+                    population.write(fragment)
+                    failed.extend(shard_failed)
+                if shard_tours is not None:
+                    yield from shard_tours
+        if tour_json is not None:
+            tour_io.write_tours(get_tours(), tour_json)
+        else:
+            for _ in get_tours():
+                pass
+    if decorate:
+        with open(output_file + ".failed.json", "w") as f:
+            json.dump(failed, f, indent=4)
+    return seed
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import distribution
+
+def split_round_trips_loop(df_total):
+    # The row by row loop split_round_trips replaced, except that it writes
+    # the midpoint to STRTTIME instead of the misspelled STRTIME
+    df_total = df_total.reset_index(drop=True)
+    spare_rows = []
+    for i in range(len(df_total.index)):
+        if (df_total.at[i, "LOOP_TRIP"] == 1):
+            df_total.at[i, "TRPMILES"] = df_total.at[i, "TRPMILES"] / 2.0
+            spare_row = df_total.iloc[i,:].copy(deep=True)
+            spare_row["WHYTO"], spare_row["WHYFROM"] = spare_row["WHYFROM"], spare_row["WHYTO"]
+            spare_row['TDTRPNUM'] = spare_row['TDTRPNUM'] + 0.5
+            start_time = spare_row["STRTTIME"]
+            end_time = spare_row["ENDTIME"]
+            hour_diff = ((end_time // 100) - (start_time // 100))
+            if hour_diff < 0:
+                hour_diff = 23 - hour_diff
+            minute_diff = (hour_diff % 2) * 30
+            hour_diff = (hour_diff // 2)
+            minute_diff += ((end_time % 100) - (start_time % 100))
+            new_minutes = (start_time % 100) + minute_diff
+            if new_minutes > 59:
+                hour_carry = 1
+                new_minutes = new_minutes - 59
+            else:
+                hour_carry = 0
+                if new_minutes < 0:
+                    new_minutes = new_minutes + 59
+            new_hour = ((start_time // 100) + hour_carry + hour_diff) % 24
+            final_time = new_hour * 100 + new_minutes
+            df_total.at[i, "ENDTIME"] = final_time
+            spare_row["STRTTIME"] = final_time
+            spare_rows.append(spare_row)
+    return pd.concat([df_total, pd.DataFrame(spare_rows)], ignore_index=True)
+
+def make_trips(rows):
+    columns = ["HOUSEID", "PERSONID", "TDTRPNUM", "TRPMILES", "TRPTRANS", "WHYFROM",
+            "LOOP_TRIP", "WHYTO", "STRTTIME", "ENDTIME"]
+    df = pd.DataFrame(rows, columns=columns)
+    return df.astype({column : distribution.trippub_dtypes[column] for column in columns})
+
+def check_matches_loop(df):
+    result = distribution.split_round_trips(df.copy())
+    expected = split_round_trips_loop(df.copy())
+    # The loop's rows are built one at a time so their dtypes are lost
+    assert_frame_equal(result, expected.astype(result.dtypes.to_dict()))
+    return result
+
+def test_fixed_rows():
+    df = make_trips([
+        # Across midnight
+        [1, 1, 1, 4.0, 3, 1, 1, 1, 2330, 30],
+        [1, 1, 2, 2.5, 3, 1, 1, 1, 2359, 0],
+        # Not a round trip
+        [1, 2, 1, 7.0, 1, 1, 2, 11, 800, 845],
+        # Odd hour difference, minutes carrying into the next hour
+        [2, 1, 1, 3.0, 4, 13, 1, 13, 1045, 1350],
+        # Negative minute difference
+        [2, 1, 2, 1.0, 4, 13, 1, 13, 1250, 1310],
+        [2, 1, 3, 6.0, 4, 13, 1, 13, 900, 900],
+    ])
+    # A non contiguous index like the filtering leaves
+    df.index = [3, 5, 8, 13, 21, 34]
+    result = check_matches_loop(df)
+    assert len(result) == 11
+    assert result["STRTTIME"].dtype == np.int16
+    assert result["ENDTIME"].dtype == np.int16
+    assert result["TDTRPNUM"].dtype == np.float32
+    spare_rows = result.iloc[6:]
+    assert spare_rows["TDTRPNUM"].tolist() == [1.5, 2.5, 1.5, 2.5, 3.5]
+    assert spare_rows["STRTTIME"].tolist() == result.iloc[[0, 1, 3, 4, 5]]["ENDTIME"].tolist()
+
+def test_random_rows():
+    rng = np.random.default_rng(0)
+    n = 2000
+    df = make_trips({
+        "HOUSEID" : rng.integers(0, 300, n),
+        "PERSONID" : rng.integers(1, 4, n),
+        "TDTRPNUM" : rng.integers(1, 8, n),
+        "TRPMILES" : rng.random(n) * 30,
+        "TRPTRANS" : rng.integers(1, 18, n),
+        "WHYFROM" : rng.integers(1, 20, n),
+        "LOOP_TRIP" : rng.integers(1, 3, n),
+        "WHYTO" : rng.integers(1, 20, n),
+        "STRTTIME" : rng.integers(0, 24, n) * 100 + rng.integers(0, 60, n),
+        "ENDTIME" : rng.integers(0, 24, n) * 100 + rng.integers(0, 60, n),
+    })
+    df = df[df["HOUSEID"] % 7 != 0]
+    check_matches_loop(df)
+
+def test_no_round_trips():
+    df = make_trips([[1, 1, 1, 7.0, 1, 1, 2, 11, 800, 845]])
+    result = check_matches_loop(df)
+    assert len(result) == 1
@@ -0,0 +1,100 @@
+import json
+import random
+
+import pytest
+
+import tour_io
+
+def make_tours(num_tours, first_tour=0, seed=0):
+    # Tours shaped like the ones select_trips builds, with long trips split
+    # into a temporary step and a short one
+    rng = random.Random(seed)
+    tours = []
+    for tour_number in range(first_tour, first_tour + num_tours):
+        steps = []
+        for _ in range(rng.randint(1, 6)):
+            distance = round(rng.uniform(0.1, 80.0), 3)
+            mode = rng.choice(["Car", "Walk", "Transit", "Bicycle"])
+            if distance > 50.0:
+                steps.append({'dist' : distance, 'mode' : mode, 'dest_encoding' : 97,
+                    'temp' : True})
+                distance = 0.5
+            start = rng.randint(0, 23 * 60)
+            steps.append({'dist' : distance, 'dest_encoding' : rng.randint(1, 19), 'mode' : mode,
+                'start time' : tour_io.format_time(start),
+                'end time' : tour_io.format_time(start + rng.randint(0, 59)), 'temp' : False})
+        tour_info = {'plan' : steps, 'student' : rng.random() < 0.3,
+                'employed' : rng.random() < 0.6}
+        tours.append({"Tour {}".format(tour_number) : tour_info})
+    return tours
+
+def dump(tours):
+    # json.dumps keeps key order, so equal dumps also means the same key order
+    return json.dumps(list(tours))
+
+@pytest.mark.parametrize("name", ["tours.json", "tours.jsonl", "tours.tours"])
+def test_round_trip(tmp_path, name):
+    tours = make_tours(50)
+    tour_json = str(tmp_path / name)
+    tour_io.write_tours(tours, tour_json)
+    assert dump(tour_io.read_tours(tour_json)) == dump(tours)
+
+@pytest.mark.parametrize("name", ["tours.json", "tours.jsonl", "tours.tours"])
+def test_round_trip_no_tours(tmp_path, name):
+    tour_json = str(tmp_path / name)
+    tour_io.write_tours([], tour_json)
+    assert list(tour_io.read_tours(tour_json)) == []
+
+def test_columns_in_chunks(tmp_path):
+    tours = make_tours(23)
+    path = str(tmp_path / "tours.tours")
+    writer = tour_io.TourColumnsWriter(path, chunk_size=4)
+    for tour in tours:
+        writer.write(tour)
+    writer.close()
+    columns = tour_io.TourColumns(path, chunk_size=5)
+    assert len(columns) == 23
+    assert dump(columns) == dump(tours)
+
+def test_columns_read_ranges(tmp_path):
+    tours = make_tours(30)
+    path = str(tmp_path / "tours.tours")
+    tour_io.write_tours(tours, path)
+    columns = tour_io.TourColumns(path)
+    for start, end in [(0, 30), (0, 1), (29, 30), (7, 19), (12, 13)]:
+        assert dump(columns.read(start, end)) == dump(tours[start:end])
+    for start in [0, 11, 30]:
+        assert columns.read(start, start) == []
+
+def test_append(tmp_path):
+    tours = make_tours(20)
+    for name in ["tours.jsonl", "tours.tours"]:
+        tour_json = str(tmp_path / name)
+        tour_io.write_tours(tours[:12], tour_json)
+        for _ in tour_io.write_tours_as_generated(tours[12:], tour_json, append=True):
+            pass
+        assert dump(tour_io.read_tours(tour_json)) == dump(tours)
+
+def test_append_after_crash(tmp_path):
+    # A run that crashed after flushing a chunk but before writing meta.json
+    # leaves column files longer than meta.json says
+    tours = make_tours(20)
+    path = str(tmp_path / "tours.tours")
+    tour_io.write_tours(tours[:8], path)
+    for column in list(tour_io.step_columns) + list(tour_io.tour_columns):
+        with open(path + "/" + column + ".bin", "ab") as f:
+            f.write(b"\x07" * 24)
+    assert dump(tour_io.read_tours(path)) == dump(tours[:8])
+    for _ in tour_io.write_tours_as_generated(tours[8:], path, append=True):
+        pass
+    assert dump(tour_io.read_tours(path)) == dump(tours)
+
+def test_unfinished_columns_are_not_read(tmp_path):
+    path = str(tmp_path / "tours.tours")
+    writer = tour_io.TourColumnsWriter(path, chunk_size=2)
+    for tour in make_tours(5):
+        writer.write(tour)
+    with pytest.raises(FileNotFoundError):
+        tour_io.TourColumns(path)
+    writer.close()
+    assert len(tour_io.TourColumns(path)) == 5
@@ -0,0 +1,231 @@
+import json
+import os
+import re
+import numpy as np
+
+# Tours are stored either as one pretty printed json list (the original
+# format) or, for files ending in .jsonl, as one compact json tour per line
+# so they can be appended to and read back incrementally.
+#
+# Paths ending in .tours are instead a directory of flat columns, one raw
+# array file per column plus meta.json. Step columns hold every step of
+# every tour back to back and tour_steps holds where each tour's steps end.
+# Times are minutes after midnight (-1 for steps without times) and modes
+# are indices into the mode names in meta.json. The columns are memory
+# mapped when read, so any range of tours can be read without the rest.
+
+COLUMNS_VERSION = 1
+
+step_columns = {"dist" : np.float64, "dest" : np.int16, "mode" : np.int8,
+        "start" : np.int16, "end" : np.int16, "temp" : np.bool_}
+tour_columns = {"tour_number" : np.int64, "tour_steps" : np.int64, "student" : np.bool_,
+        "employed" : np.bool_}
+
+def is_line_delimited(tour_json):
+    return tour_json.endswith(".jsonl")
+
+def is_columnar(tour_json):
+    return tour_json.rstrip("/").endswith(".tours")
+
+def can_append(tour_json):
+    return is_line_delimited(tour_json) or is_columnar(tour_json)
+
+def write_tours(tours, tour_json):
+    if can_append(tour_json):
+        for _ in write_tours_as_generated(tours, tour_json):
+            pass
+    else:
+        with open(tour_json, "w") as f:
+            f.write(json.dumps(list(tours), indent=4))
+            f.flush()
+
+def write_tours_as_generated(tours, tour_json, append=False):
+    # Passes each tour through after writing it as a line of tour_json
+    if is_columnar(tour_json):
+        writer = TourColumnsWriter(tour_json, append)
+        for tour in tours:
+            writer.write(tour)
+            yield tour
+        writer.close()
+        return
+    with open(tour_json, "a" if append else "w") as f:
+        for tour in tours:
+            f.write(json.dumps(tour))
+            f.write("\n")
+            yield tour
+        f.flush()
+
+def read_tours(tour_json):
+    if is_columnar(tour_json):
+        return TourColumns(tour_json)
+    if is_line_delimited(tour_json):
+        return read_tour_lines(tour_json)
+    with open(tour_json, "r") as f:
+        return json.load(f)
+
+def read_tour_lines(tour_json):
+    with open(tour_json, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def format_time(minutes):
+    # Minutes after midnight as "H:MM"
+    return "{}:{:02d}".format(*divmod(int(minutes), 60))
+
+def format_times(minutes):
+    # format_time for an array, formatting each distinct time once
+    unique_minutes, inverse = np.unique(minutes, return_inverse=True)
+    labels = [format_time(minute) for minute in unique_minutes]
+    return np.array(labels, dtype=object)[inverse]
+
+def parse_time(time_info):
+    hours, minutes = time_info.split(":")
+    return int(hours or 0) * 60 + int(minutes)
+
+class TourColumnsWriter:
+
+    # Buffers tours and appends them to the column files chunk_size tours at
+    # a time. meta.json is only written by close, so a directory that is
+    # still being written is never read as complete.
+    def __init__(self, path, append=False, chunk_size=10000):
+        self.path = path.rstrip("/") + "/"
+        self.chunk_size = chunk_size
+        self.num_tours = 0
+        self.num_steps = 0
+        self.modes = []
+        meta_file = self.path + "meta.json"
+        if append and os.path.exists(meta_file):
+            meta = read_meta(self.path)
+            self.num_tours = meta["tours"]
+            self.num_steps = meta["steps"]
+            self.modes = meta["modes"]
+        else:
+            append = False
+            os.makedirs(self.path, exist_ok=True)
+            if os.path.exists(meta_file):
+                os.remove(meta_file)
+        self.mode_codes = {mode : code for code, mode in enumerate(self.modes)}
+        self.files = dict()
+        for columns, length in ((step_columns, self.num_steps), (tour_columns, self.num_tours)):
+            for column, dtype in columns.items():
+                f = open(self.path + column + ".bin", "ab" if append else "wb")
+                # Drop anything written after meta.json, e.g. by a run that crashed
+                f.truncate(length * np.dtype(dtype).itemsize)
+                self.files[column] = f
+        self.clear()
+
+    def clear(self):
+        self.buffers = {column : [] for column in self.files}
+
+    def write(self, tour):
+        tour_id, tour_info = next(iter(tour.items()))
+        match = re.fullmatch(r"Tour (\d+)", tour_id)
+        if match is None:
+            raise ValueError("Can't store tour id {} in columns".format(tour_id))
+        for step in tour_info["plan"]:
+            self.buffers["dist"].append(step["dist"])
+            self.buffers["dest"].append(step["dest_encoding"])
+            self.buffers["mode"].append(self.get_mode_code(step["mode"]))
+            self.buffers["start"].append(parse_time(step["start time"]) if "start time" in step else -1)
+            self.buffers["end"].append(parse_time(step["end time"]) if "end time" in step else -1)
+            self.buffers["temp"].append(step["temp"])
+        self.num_steps += len(tour_info["plan"])
+        self.buffers["tour_number"].append(int(match.group(1)))
+        self.buffers["tour_steps"].append(self.num_steps)
+        self.buffers["student"].append(tour_info["student"])
+        self.buffers["employed"].append(tour_info["employed"])
+        self.num_tours += 1
+        if len(self.buffers["tour_number"]) >= self.chunk_size:
+            self.flush()
+
+    def get_mode_code(self, mode):
+        code = self.mode_codes.get(mode)
+        if code is None:
+            code = self.mode_codes[mode] = len(self.modes)
+            self.modes.append(mode)
+        return code
+
+    def flush(self):
+        dtypes = dict(step_columns, **tour_columns)
+        for column, values in self.buffers.items():
+            np.asarray(values, dtype=dtypes[column]).tofile(self.files[column])
+        self.clear()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        meta_file = self.path + "meta.json"
+        with open(meta_file + ".tmp", "w") as f:
+            json.dump({"version" : COLUMNS_VERSION, "tours" : self.num_tours,
+                    "steps" : self.num_steps, "modes" : self.modes}, f, indent=4)
+        os.replace(meta_file + ".tmp", meta_file)
+
+def read_meta(path):
+    with open(path + "meta.json", "r") as f:
+        meta = json.load(f)
+    if meta["version"] != COLUMNS_VERSION:
+        raise ValueError("{} has tour columns version {}, expected {}".format(path,
+                meta["version"], COLUMNS_VERSION))
+    return meta
+
+class TourColumns:
+
+    # Memory mapped tours written by TourColumnsWriter. Iterating yields the
+    # same tour dicts that were written; read(start, end) gives a range.
+    def __init__(self, path, chunk_size=10000):
+        self.path = path.rstrip("/") + "/"
+        self.chunk_size = chunk_size
+        meta = read_meta(self.path)
+        self.modes = meta["modes"]
+        self.columns = dict()
+        for column, dtype in step_columns.items():
+            self.columns[column] = map_column(self.path + column + ".bin", dtype, meta["steps"])
+        for column, dtype in tour_columns.items():
+            self.columns[column] = map_column(self.path + column + ".bin", dtype, meta["tours"])
+
+    def __len__(self):
+        return self.columns["tour_number"].shape[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            yield from self.read(start, min(start + self.chunk_size, len(self)))
+
+    def read(self, start, end):
+        tour_steps = self.columns["tour_steps"]
+        first_step = 0 if start == 0 else int(tour_steps[start - 1])
+        last_step = int(tour_steps[end - 1]) if end > start else first_step
+        steps = {column : self.columns[column][first_step:last_step] for column in step_columns}
+        steps["mode"] = np.array(self.modes, dtype=object)[steps["mode"]]
+        steps["start"] = format_times(steps["start"])
+        steps["end"] = format_times(steps["end"])
+        steps = {column : values.tolist() for column, values in steps.items()}
+        tour_numbers = self.columns["tour_number"][start:end].tolist()
+        step_ends = tour_steps[start:end].tolist()
+        students = self.columns["student"][start:end].tolist()
+        employed = self.columns["employed"][start:end].tolist()
+        tours = []
+        step_start = 0
+        for tour_index in range(end - start):
+            step_end = step_ends[tour_index] - first_step
+            plan = [self.get_step(steps, i) for i in range(step_start, step_end)]
+            step_start = step_end
+            tours.append({"Tour {}".format(tour_numbers[tour_index]) : {'plan' : plan,
+                'student' : students[tour_index], 'employed' : employed[tour_index]}})
+        return tours
+
+    def get_step(self, steps, i):
+        # Temporary steps are written without times, in their own key order
+        if steps["temp"][i]:
+            return {'dist' : steps["dist"][i], 'mode' : steps["mode"][i],
+                    'dest_encoding' : steps["dest"][i], 'temp' : True}
+        return {'dist' : steps["dist"][i], 'dest_encoding' : steps["dest"][i],
+                'mode' : steps["mode"][i], 'start time' : steps["start"][i],
+                'end time' : steps["end"][i], 'temp' : False}
+
+def map_column(column_file, dtype, length):
+    # np.memmap can't map an empty file
+    if length == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(column_file, dtype=dtype, mode="r", shape=(length,))